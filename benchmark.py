@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# benchmark.py - measures the export of dex2xml.py without a MySQL server or the DEXonline dump
+#
+# A synthetic database with the shape of DEXonline (Source, Definition, LexemDefinitionMap,
+# LexemModel and InflectedForm) is generated in the format of the --dump index, so dex2xml reads it
+# through the same stand-in for the pymysql connection it uses for SQL dumps.
+#
+# usage: benchmark.py [-n DEFINITIONS] [--seed SEED] [--duplicates DUPLICATES] [--fixture FIXTURE] [-r RESULTS] [-- dex2xml arguments]
+#
+# e.g.:  benchmark.py -n 50000 -- -src 27 36 12 --stream
+#        benchmark.py --duplicates 50 -- --dedup -g
+#
+# The results of each run are appended to the RESULTS file (default: 'benchmark.json'),
+# and compared with the previous run having the same fixture and arguments. With --dedup,
+# the duplicates merged are checked against the ones found in the fixture.
+
+import sys
+import os
+import time
+import collections
+import json
+import glob
+import random
+import shutil
+import sqlite3
+import tempfile
+import platform
+import subprocess
+import argparse
+from argparse import RawTextHelpFormatter
+
+try:
+	import resource
+except ImportError:
+	resource = None	# not available on Windows
+
+import dex2xml
+
+SOURCES = [(27,u'DEX','2009',1),(36,u'DOOM 2','2005',1),(12,u'MDA','2010',1),(99,u'DLRLC','1955',0)]
+
+# the syllables of the headwords; about a third of the headwords get a comma diacritic
+SYLLABLES = [u'ba',u'ca',u'ri',u'lu',u'ne',u'ti',u'pe',u'ra',u've',u'co',u'gu',u'fi',u'zo',u'cu',u'ni',u'mo',u'de',u'an',u'tre',u'sti',u'pro',u'in',u'e',u'o']
+DIACRITICSYLLABLES = [u'ță',u'șo',u'mă',u'sâ',u'dî',u'șe',u'ța',u'ște',u'ți',u'ăr',u'în',u'țu']
+
+# the endings of the inflected forms, by the kind of inflection model
+NOUNENDINGS = [u'',u'ul',u'ului',u'uri',u'urile',u'urilor',u'ule',u'ă',u'a',u'ei',u'e',u'ele',u'elor']
+ADJECTIVEENDINGS = [u'',u'ul',u'ului',u'ă',u'a',u'ei',u'i',u'ii',u'ilor',u'e',u'ele',u'elor',u'ule',u'ilor',u'o',u'elor']
+VERBENDINGS = [u'a',u'ez',u'ezi',u'ează',u'ăm',u'ați',u'au',u'am',u'ai',u'a',u'ară',u'arăm',u'arăți',u'aseră',u'asem',u'aseși',u'ase',u'aserăm',u'aserăți',
+	u'ând',u'ându-',u'at',u'ată',u'ați',u'ate',u'atul',u'ata',u'aților',u'atelor',u'ai',u'aseși',u'ești',u'ește',u'esc',u'im',u'iți',u'eau',u'eam',
+	u'eai',u'ea',u'eați',u'ise',u'iseră',u'isem',u'iseși',u'ind',u'it',u'ită',u'iți',u'ite',u'itul',u'ita',u'iților',u'itelor',u'ească',u'ești',u'iți']
+INFLECTIONMODELS = [(NOUNENDINGS,0.55),(ADJECTIVEENDINGS,0.25),(VERBENDINGS,0.20)]
+
+ABBREVIATIONS = [(u's. m.',u'substantiv masculin'),(u's. f.',u'substantiv feminin'),(u's. n.',u'substantiv neutru'),(u'adj.',u'adjectiv'),(u'vb. I',u'verb de conjugarea I'),(u'vb. IV',u'verb de conjugarea a IV-a'),(u'pop.',u'popular'),(u'fig.',u'figurat')]
+
+def randomWord(rnd,diacritics):
+	syllables = [rnd.choice(SYLLABLES) for i in range(rnd.randint(2,4))]
+	if diacritics:
+		syllables[rnd.randrange(len(syllables))] = rnd.choice(DIACRITICSYLLABLES)
+	return u''.join(syllables)
+
+def randomDefinition(rnd,termen):
+	(abbrev,title) = rnd.choice(ABBREVIATIONS)
+	words = [randomWord(rnd,rnd.random() < 0.2) for i in range(rnd.randint(8,70))]
+	for i in range(0,len(words),rnd.randint(6,12)):
+		words[i] = u'<i>%s</i>' % words[i]
+	text = u' '.join(words)
+	if rnd.random() < 0.1:
+		text = text.replace(u' ',u'\n',1)	# a few definitions span several lines, as in the real data
+	return u'<b>%s</b> <abbr class="abbrev" title="%s">%s</abbr> %s.' % (termen.upper(),title,abbrev,text)
+
+def inflectionModel(rnd):
+	x = rnd.random()
+	for (endings,probability) in INFLECTIONMODELS:
+		if x < probability:
+			return endings
+		x -= probability
+	return NOUNENDINGS
+
+def generateFixture(filename,definitions,seed,duplicates = 0):
+	# writes a database with the tables and indexes of the dump index of dex2xml
+	start_time = time.time()
+	rnd = random.Random(seed)
+	db = sqlite3.connect(filename)
+	db.create_collation('general_ci',dex2xml.generalCiCompare)
+	db.execute("pragma synchronous = off")
+	db.execute("pragma journal_mode = off")
+	for table in dex2xml.DUMPTABLES:
+		db.execute("create table %s (%s)" % (table,', '.join('%s %s' % column for column in dex2xml.DUMPTABLES[table])))
+	db.executemany("insert into Source values (?,?,?,?)",SOURCES)
+
+	headwords = set()
+	iddef = 0
+	idlexem = 0
+	idmodel = 0
+	candidates = []
+	while iddef < definitions:
+		termen = randomWord(rnd,rnd.random() < 0.35)
+		if termen in headwords:
+			continue
+		headwords.add(termen)
+
+		# a headword has one or two lexemes (homonyms), each with one or two inflection models
+		lexemes = []
+		models = []
+		forms = []
+		for i in range(1 if rnd.random() < 0.9 else 2):
+			idlexem += 1
+			lexemes.append(idlexem)
+			for j in range(1 if rnd.random() < 0.85 else 2):
+				idmodel += 1
+				models.append((idmodel,idlexem))
+				stem = termen[:-1] if len(termen) > 3 else termen
+				forms.extend((idmodel,stem + ending) for ending in inflectionModel(rnd))
+
+		# and a definition in one to four of the sources, some of them not active
+		rows = []
+		maps = []
+		for (sourceid,sourcename,year,candistribute) in rnd.sample(SOURCES,rnd.randint(1,len(SOURCES))):
+			iddef += 1
+			status = 0 if rnd.random() < 0.97 else 1
+			rows.append((iddef,sourceid,termen,randomDefinition(rnd,termen),status,1400000000 + rnd.randint(0,200000000)))
+			maps.extend((idlexem,iddef) for idlexem in lexemes)
+			if status == 0 and sourceid in (SOURCES[0][0],SOURCES[1][0]):
+				candidates.append((rows[-1],lexemes))
+		db.executemany("insert into Definition values (?,?,?,?,?,?)",rows)
+		db.executemany("insert into LexemDefinitionMap values (?,?)",maps)
+		db.executemany("insert into LexemModel values (?,?)",models)
+		db.executemany("insert into InflectedForm values (?,?)",forms)
+
+	if duplicates:
+		# definitions repeating another one of the headword, but for the spaces, in the other of the first two sources;
+		# half of them for the headwords equal to others in the general_ci collation (as "tira" and "țira")
+		keys = collections.Counter(dex2xml.generalCiKey(termen) for termen in headwords)
+		colliding = [candidate for candidate in candidates if keys[dex2xml.generalCiKey(candidate[0][2])] > 1]
+		others = [candidate for candidate in candidates if keys[dex2xml.generalCiKey(candidate[0][2])] == 1]
+		half = min(duplicates // 2,len(colliding))
+		for ((original,sourceid,termen,text,status,moddate),lexemes) in rnd.sample(colliding,half) + rnd.sample(others,duplicates - half):
+			iddef += 1
+			sourceid = SOURCES[1][0] if sourceid == SOURCES[0][0] else SOURCES[0][0]
+			db.execute("insert into Definition values (?,?,?,?,?,?)",(iddef,sourceid,termen,text.replace(u' ',u'  ',2) + u' ',status,moddate))
+			db.executemany("insert into LexemDefinitionMap values (?,?)",[(idlexem,iddef) for idlexem in lexemes])
+	
+	for index in dex2xml.DUMPINDEXES:
+		db.execute(index)
+	db.commit()
+	db.close()
+	print("Fixture with %s definitions and %s headwords generated in %.1f s" % (iddef,len(headwords),time.time() - start_time))
+
+def expectedDuplicates(fixture,sources):
+	# the definitions of a headword repeating another one but for the spaces, which --dedup exports once
+	db = dex2xml.DumpConnection(fixture)
+	texts = collections.defaultdict(set)
+	count = 0
+	for (termen,text) in db.db.execute("select lexicon,replace(htmlRep,'\n','') " + dex2xml.DEFINITIONSFILTER % ','.join(sources)):
+		text = dex2xml.DEDUPSPACE.sub(u' ',text).strip()
+		if text in texts[termen]:
+			count += 1
+		texts[termen].add(text)
+	db.close()
+	return count
+
+def peakMemory():
+	# in MB, including the worker processes of --jobs
+	if not resource:
+		return None
+	maxrss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+	if sys.platform == 'darwin':
+		maxrss = maxrss / 1024	# bytes on Mac OS X, kilobytes on Linux
+	return round(maxrss / 1024.0,1)
+
+def runExport(fixture,outputfile,arguments):
+	# runs in a process of its own (see main), so the peak memory is that of a single export
+	options = dex2xml.argumentParser().parse_args(['-b','-k','--dump',fixture,'-o',outputfile] + arguments)
+	dex2xml.dump_index = fixture	# already in the format of the dump index
+	exporter = dex2xml.Exporter(dex2xml.DumpConnection(fixture),options)
+
+	db = dex2xml.DumpConnection(fixture)
+	definitions = db.db.execute("select count(*) " + dex2xml.DEFINITIONSFILTER % ','.join(options.sources or dex2xml.DEFAULTSOURCES)).fetchone()[0]
+	db.close()
+
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull,'w')
+	try:
+		start_time = time.time()
+		exporter.export()
+		duration = time.time() - start_time
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+	exporter.close()
+	duplicates = None
+	if options.dedup:
+		duplicates = {"merged": dex2xml.duplicate_count,"expected": expectedDuplicates(fixture,options.sources or dex2xml.DEFAULTSOURCES)}
+
+	# the letter files, TOC, stats and OPF (or the --epub containers) of all the editions
+	outputbytes = sum(os.path.getsize(filename) for filename in glob.glob(outputfile + '*'))
+	return {
+		"definitions": definitions,
+		"entries": dex2xml.entry_count,
+		"duration": round(duration,3),
+		"definitions_per_second": round(definitions / max(duration,0.001),1),
+		"queries": dex2xml.query_count,
+		"peak_memory_mb": peakMemory(),
+		"output_bytes": outputbytes,
+		"duplicates": duplicates,
+	}
+
+def previousRun(results,run):
+	for previous in reversed(results):
+		if previous["fixture"] == run["fixture"] and previous["arguments"] == run["arguments"]:
+			return previous
+	return None
+
+def main():
+	parser = argparse.ArgumentParser(description="Measures the export of dex2xml.py on a synthetic DEXonline database.",formatter_class=RawTextHelpFormatter)
+	parser.add_argument("-n","--definitions",help="Number of definitions of the synthetic database.\nDefault: 20000",type=int,default=20000)
+	parser.add_argument("--seed",help="Seed of the synthetic database.\nDefault: 1",type=int,default=1)
+	parser.add_argument("--duplicates",help="Number of definitions of the synthetic database repeating another one of the headword but for the spaces.\nDefault: 0",type=int,default=0)
+	parser.add_argument("--fixture",help="Keep the synthetic database in this file and reuse it in the next runs.\nDefault: not set",type=str)
+	parser.add_argument("-r","--results",help="JSON file the results are appended to.\nDefault: 'benchmark.json'",type=str,default="benchmark.json")
+	parser.add_argument("--export",help=argparse.SUPPRESS,nargs=2)
+	parser.add_argument("arguments",help="Arguments passed to dex2xml.py (after '--').",nargs=argparse.REMAINDER)
+	args = parser.parse_args()
+	arguments = [argument for argument in args.arguments if argument != '--']
+
+	if args.export:
+		# the export itself, in the child process
+		print(json.dumps(runExport(args.export[0],args.export[1],arguments)))
+		return
+
+	workdir = tempfile.mkdtemp(prefix='dex2xml_benchmark_')
+	try:
+		fixture = args.fixture or os.path.join(workdir,'fixture.sqlite')
+		if not os.path.isfile(fixture):
+			generateFixture(fixture,args.definitions,args.seed,args.duplicates)
+		for filename in ['Abrevieri.html','cover.jpg']:
+			shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)),filename),workdir)
+
+		output = subprocess.check_output([sys.executable,os.path.abspath(__file__),'--export',os.path.abspath(fixture),'bench','--'] + arguments,cwd = workdir)
+		run = {
+			"date": time.strftime('%Y-%m-%d %H:%M:%S'),
+			"version": dex2xml.VERSION,
+			"python": platform.python_version(),
+			"fixture": {"definitions": args.definitions,"seed": args.seed,"duplicates": args.duplicates} if not args.fixture else {"file": os.path.abspath(args.fixture)},
+			"arguments": arguments,
+		}
+		run.update(json.loads(output.splitlines()[-1]))
+	finally:
+		shutil.rmtree(workdir,ignore_errors = True)
+
+	results = []
+	if os.path.isfile(args.results):
+		with open(args.results) as f:
+			results = json.load(f)
+	previous = previousRun(results,run)
+	results.append(run)
+	with open(args.results,'w') as f:
+		json.dump(results,f,indent = 1,sort_keys = True)
+
+	print("Definitions exported: %s (%s entries)" % (run["definitions"],run["entries"]))
+	print("Definitions per second: %s" % run["definitions_per_second"])
+	print("Queries issued: %s" % run["queries"])
+	print("Peak memory usage: %s MB" % run["peak_memory_mb"])
+	print("Output size: %.1f MB" % (run["output_bytes"] / 1048576.0))
+	if previous:
+		print("Previous run (%s): %s definitions per second, %s MB, %s queries" % (previous["date"],previous["definitions_per_second"],previous["peak_memory_mb"],previous["queries"]))
+	print("Results saved in '%s'" % args.results)
+	if run["duplicates"]:
+		print("Duplicate definitions merged: %s of %s" % (run["duplicates"]["merged"],run["duplicates"]["expected"]))
+		if run["duplicates"]["merged"] != run["duplicates"]["expected"]:
+			print("Not all the duplicate definitions were merged by --dedup")
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -18,16 +18,43 @@
 # Requirements:
 # -------------
 # * Linux or Windows enivronment
-# * MySQL server
+# * MySQL server (or the DEXonline SQL dump file, see --dump)
 # * copy of DEXonline database - download and installation instructions: http://wiki.dexonline.ro/wiki/Instruc%C8%9Biuni_de_instalare
 # * Python (this script was created and tested using Python 2.7)
 # * PyMySql package (compiled from sources or installed using "pip install pymysql")
 # 
 # optional:
-# * kindlegen for generating MOBI format (available for Linux/Windows/Mac at http://www.amazon.com/gp/feature.html?docId=1000765211)
+# * kindlegen for generating MOBI format (available for Linux/Windows/Mac at http://www.amazon.com/gp/feature.html?docId=1000765211),
+#   or the MOBI writer built in dex2xml (see --mobi-writer)
 # 
 # Version history:
 # ----------------
+#     0.9.2
+#         inflections are fetched in batches instead of one query per definition
+#         added parameter to stream the definitions from the server (constant memory usage)
+#         added parameter to read the definitions directly from a SQL dump, without a MySQL server
+#         added parameter to export the letter files in parallel processes
+#         added incremental mode, exporting only the letter files that changed since the previous run
+#         added parameter to group all the definitions of a headword in a single entry
+#         entries are rendered in memory and written in large chunks, progress is shown twice a second
+#         added 'all' diacritics option, exporting also the forms without diacritics
+#         added parameters to split the large letter files by size or number of entries
+#         added parameter to export several editions (diacritics options) in a single run
+#         kindlegen conversions of the editions run in parallel, with timeout and a log file for each
+#         added benchmark.py, measuring the export on a synthetic database
+#         added parameter to write a JSON report with the time spent in each phase of the export
+#         added the Exporter class, to export from other programs reusing the connections
+#         added parameter to write the dictionary straight into an EPUB container, without temporary files
+#         added a built-in MOBI writer, converting the dictionary without kindlegen
+#         the definitions are read with a checkpoint every 20000 of them, to resume an interrupted export
+#         added parameter to write also StarDict and dictd dictionaries, from the same export
+#         added parameter to write a lookup index of the headwords and inflected forms, searched by lookup.py
+#         added parameter to read, render and write the entries in a pipeline of three threads
+#         added parameter to export only once the identical definitions of a headword
+#         added parameter to sort the definitions in the Romanian alphabetical order, with an external merge sort
+#         added parameter to minify the HTML of the definitions
+#         added parameter to export a compact edition fitting in a size budget
+# 
 #     0.9.1
 #         added parameter to select how the diacritics should be exported (comma, cedilla, both)
 # 
@@ -71,7 +98,7 @@
 # Boston, MA 02111-1307, USA.
 
 # VERSION
-VERSION = "0.9.1"
+VERSION = "0.9.2"
 
 import sys
 import signal
@@ -80,19 +107,50 @@ import os
 import time
 import errno
 import glob
+import io
+import collections
+import gzip
+import sqlite3
+import tempfile
+import atexit
+import multiprocessing
+import hashlib
+import json
+import heapq
+import zipfile
+import zlib
+import struct
+import shutil
+import mmap
+import array
+import threading
+import Queue
+import marshal
+import itertools
+
+try:
+	import resource
+except ImportError:
+	resource = None	# not available on Windows
 
 from unicodedata import normalize, decomposition, combining
 import string
 from exceptions import UnicodeEncodeError
+from HTMLParser import HTMLParser
 
-import pymysql
+try:
+	import pymysql
+	import pymysql.cursors
+except ImportError:
+	pymysql = None	# only needed when reading from a MySQL server
 import codecs
 import getpass
 import subprocess
 import argparse
 from argparse import RawTextHelpFormatter
 
-source_list = ["27","36"]
+DEFAULTSOURCES = ["27","36"]
+source_list = list(DEFAULTSOURCES)
 source_list_names = []
 source_list_count = []
 
@@ -101,11 +159,76 @@ mysql_port = ''
 mysql_user = ''
 mysql_passwd = ''
 mysql_db = ''
+dump_index = ''
 name = ''
+# diacritics option of the edition being exported
+diacritics = ''
+editions = []
 conn =''
+conn2 = ''
 cur = ''
 cur2 = ''
 to = ''
+# the writers of the other formats (--formats) and the lookup index (--lookup-index) of the active edition
+writers = []
+lookup = None
+# the writer thread of --pipeline, while the letters are exported
+letter_writer = None
+
+# number of definitions whose inflections are fetched with a single query
+INFLECTION_WINDOW = 1000
+# number of definitions read between two checkpoints of the export
+DEFINITIONSCHUNK = 20000
+
+DEFINITIONCOLUMNS = "d.id,d.sourceId,lexicon,replace(htmlRep,'\n','') as htmlRep, concat(s.name,' ',s.year) as source"
+DEFINITIONSFILTER = "from Definition d join Source s on d.sourceId = s.id where s.id in (%s) and lexicon <>'' and status = 0"
+# the lexicons equal in the general_ci collation (e.g. "tira" and "țira") are ordered by their exact text,
+# so the definitions of a headword are consecutive; the exact lexicon is compared as binary on the mysql server
+# and with the binary collation in the dump index
+DEFINITIONSORDER = " order by lexicon asc, %(binary)s asc, s.id desc, d.id asc"
+LEXICONBINARY = {False: "binary lexicon", True: "lexicon collate binary"}
+# the definitions after the one of a checkpoint (or the last one read before the connection dropped), in the order above
+DEFINITIONSAFTER = " and (lexicon > %(lexicon)s or (lexicon = %(lexicon)s and (%(binary)s > %(lexicon)s or (%(binary)s = %(lexicon)s and (s.id < %(source)d or (s.id = %(source)d and d.id > %(id)d))))))"
+# the errors of a connection to the server that dropped while the definitions were read
+DROPPEDCONNECTION = (pymysql.OperationalError,pymysql.InterfaceError) if pymysql else ()
+inflection_cache = {}
+query_count = 0
+entry_count = 0
+progress_time = 0
+diacritic_cache = collections.OrderedDict()
+diacritic_hits = 0
+diacritic_misses = 0
+# definitions exported only once by --dedup, and the bytes of their text
+duplicate_count = 0
+duplicate_bytes = 0
+# the bytes of the definitions before and after --minify, and the seconds it took
+minify_input = 0
+minify_output = 0
+minify_time = 0
+minify_cache = collections.OrderedDict()
+abbreviations = None
+# the headwords left out by --size-budget, or exported without their inflected forms
+budget = None
+# counters summed up from the worker processes of --jobs
+COUNTERS = ['query_count','entry_count','diacritic_hits','diacritic_misses','duplicate_count','duplicate_bytes','minify_input','minify_output','minify_time']
+DEDUPSPACE = re.compile(r'\s+', re.U)
+
+# the Romanian alphabet of --client-sort, and the bytes of definitions it sorts in memory before a run
+# is written to a temporary file
+ROMANIANALPHABET = u"aăâbcdefghiîjklmnopqrsștțuvwxyz"
+SORTRUN = 16 * 1048576
+
+# number of forms whose diacritic variants are remembered
+DIACRITICSCACHE = 65536
+CEDILLATABLE = {0x0218: u"\u015E", 0x0219: u"\u015F", 0x021A: u"\u0162", 0x021B: u"\u0163"}
+STRIPTABLE = {0x0102: u"A", 0x0103: u"a", 0x00C2: u"A", 0x00E2: u"a", 0x00CE: u"I", 0x00EE: u"i",
+	0x0218: u"S", 0x0219: u"s", 0x015E: u"S", 0x015F: u"s", 0x021A: u"T", 0x021B: u"t", 0x0162: u"T", 0x0163: u"t"}
+# definitions of the headword being grouped by --group-entries (or compared by --dedup), with their inflections
+pending_definitions = []
+# time spent in each phase of the export, collected only with --metrics
+metrics = None
+# number of the slowest inflection lookups listed by --metrics
+METRICSSLOWEST = 20
 
 OPFTEMPLATEHEAD = u"""<?xml version="1.0" encoding="utf-8"?>
 <package unique-identifier="uid">
@@ -202,6 +325,22 @@ IDXTEMPLATEEND = u"""
 			</idx:entry>
 			<mbp:pagebreak/>"""
 
+IDXGROUPTEMPLATEHEAD = u"""
+					 </idx:orth>
+				</h2>"""
+
+IDXGROUPVALUETEMPLATE = u"""
+				%s
+				<hr>
+				<sup>Sursa: <i>%s</i></sup>"""
+
+IDXGROUPSEPARATORTEMPLATE = u"""
+				<br>"""
+
+IDXGROUPTEMPLATEEND = u"""
+			</idx:entry>
+			<mbp:pagebreak/>"""
+
 IDXINFTEMPLATEHEAD = u"""
 						<idx:infl>"""
 
@@ -211,6 +350,10 @@ IDXINFTEMPLATEEND = u"""
 IDXINFVALUETEMPLATE = u"""
 								<idx:iform value="%s" exact="yes" />"""
 
+# the inflections of an entry are rendered with a single join
+(IDXINFVALUEHEAD,IDXINFVALUEEND) = IDXINFVALUETEMPLATE.split('%s')
+IDXINFVALUESEPARATOR = IDXINFVALUEEND + IDXINFVALUEHEAD
+
 STATSTEMPLATEHEAD = u"""<html xmlns:math="http://exslt.org/math" xmlns:svg="http://www.w3.org/2000/svg" xmlns:tl="http://www.kreutzfeldt.de/tl" xmlns:saxon="http://saxon.sf.net/" xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:cx="http://www.kreutzfeldt.de/mmc/cx" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:mbp="http://www.kreutzfeldt.de/mmc/mbp" xmlns:mmc="http://www.kreutzfeldt.de/mmc/mmc" xmlns:idx="http://www.mobipocket.com/idx">
 	<head>
 		<meta http-equiv="Content-Type" content="text/html; charset=UTF-8">
@@ -225,77 +368,755 @@ STATSTEMPLATEHEAD = u"""<html xmlns:math="http://exslt.org/math" xmlns:svg="http
 STATSVALUETEMPLATE = u"""
 			<li><b>%s - %s</b></li>"""
 
+STATSDEDUPTEMPLATE = u"""
+		<p style="text-align:center">%s definiții identice cu alte definiții ale aceluiași cuvânt au fost exportate o singură dată, cu toate sursele lor (%.1f KB economisiți).</p>
+		<br>"""
+
+STATSBUDGETTEMPLATE = u"""
+		<p style="text-align:center">Ediție prescurtată, de cel mult %s MB: %s cuvinte (%s definiții) au fost lăsate deoparte, iar %s cuvinte au fost exportate fără formele flexionare.</p>
+		<p><b>Cuvinte lăsate deoparte:</b> %s</p>
+		<p><b>Cuvinte fără formele flexionare:</b> %s</p>
+		<br>"""
+
 STATSTEMPLATEEND = u"""
 		</ul>
-		<br>
+		<br>%s
 		<h4 style="text-align:center">Generat: %s</h4>
 	</body>
 </html>"""
 
+# number of bytes collected before a letter file is written to disk
+LETTERBUFFER = 1048576
+EPUBCONTAINER = u"""<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+	<rootfiles>
+		<rootfile full-path="%s" media-type="application/oebps-package+xml"/>
+	</rootfiles>
+</container>
+"""
+# the files copied from the directory of the output (or else of the script) into the --epub container
+EPUBRESOURCES = ['cover.jpg','Abrevieri.html']
+
+# the EPUB 3 package document and navigation document of --epub, keeping the dictionary metadata kindlegen needs
+EPUBOPFTEMPLATEHEAD = u"""<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="uid" xml:lang="ro">
+	<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+		<dc:identifier id="uid">%s</dc:identifier>
+		<dc:title>%s</dc:title>
+		<dc:language>ro</dc:language>
+		<dc:creator>dex2xml</dc:creator>
+		<dc:description>DEX online</dc:description>
+		<dc:source>http://dexonline.ro</dc:source>
+		<dc:type>dictionary</dc:type>
+		<dc:date>%s</dc:date>
+		<meta property="dcterms:modified">%s</meta>
+		<x-metadata>
+			<DictionaryInLanguage>ro</DictionaryInLanguage>
+			<DictionaryOutLanguage>ro</DictionaryOutLanguage>
+			<DefaultLookupIndex>word</DefaultLookupIndex>
+		</x-metadata>
+	</metadata>
+	<manifest>
+		<item id="cimage" href="cover.jpg" media-type="image/jpeg" properties="cover-image"/>
+		<item id="toc" href="%s.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+		<item id="stats" href="%s.html" media-type="application/xhtml+xml"/>
+		<item id="abbr" href="Abrevieri.html" media-type="application/xhtml+xml"/>
+"""
+
+EPUBOPFTEMPLATEMIDDLE = u"""	</manifest>
+	<spine>
+		<itemref idref="toc"/>
+		<itemref idref="stats"/>
+		<itemref idref="abbr"/>
+"""
+
+EPUBOPFTEMPLATEEND = u"""	</spine>
+</package>
+"""
+
+EPUBNAVTEMPLATEHEAD = u"""<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="ro" lang="ro">
+	<head>
+		<title>DEXonline - Table of Contents</title>
+	</head>
+	<body>
+		<nav epub:type="toc" id="toc">
+			<h4 style="text-align:center">Index</h4>
+			<ol>
+				<li><a href="%s.html">Statistici</a></li>
+				<li><a href="Abrevieri.html">Abrevieri</a></li>"""
+
+EPUBNAVTEMPLATEEND = u"""
+			</ol>
+		</nav>
+	</body>
+</html>
+"""
+
+# the head of the letter files of --epub, as XHTML
+EPUBFRAMESETTEMPLATEHEAD = u"""<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:math="http://exslt.org/math" xmlns:svg="http://www.w3.org/2000/svg" xmlns:tl="http://www.kreutzfeldt.de/tl" xmlns:saxon="http://saxon.sf.net/" xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:cx="http://www.kreutzfeldt.de/mmc/cx" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:mbp="http://www.kreutzfeldt.de/mmc/mbp" xmlns:mmc="http://www.kreutzfeldt.de/mmc/mmc" xmlns:idx="http://www.mobipocket.com/idx">
+	<head>
+		<meta http-equiv="Content-Type" content="text/html; charset=utf-8"/>
+		<title>DEXonline</title>
+	</head>
+	<body>
+		<mbp:frameset>"""
+
+# the XHTML of --epub: the elements without content, the empty <br> and <hr> of the entry templates,
+# and the entities XML knows
+XHTMLNAMESPACE = u"http://www.w3.org/1999/xhtml"
+XHTMLEMPTY = frozenset(['area','base','br','col','embed','hr','img','input','link','meta','param','source','track','wbr'])
+XHTMLEMPTYTAG = re.compile(r'<(br|hr)>')
+XHTMLESCAPE = {u'&': u'&amp;',u'<': u'&lt;',u'>': u'&gt;',u'"': u'&quot;'}
+XHTMLESCAPED = re.compile(u'[&<>"]')
+
+# number of seconds between two checks of the running kindlegen conversions
+KINDLEGENPOLL = 0.2
+
+# the built-in MOBI writer (--mobi-writer builtin)
+MOBIRECORDSIZE = 4096
+# an index record, with its header and the offsets of its entries, must fit in 64 KB
+MOBIINDEXSIZE = 0x10000 - 256
+MOBIINDEXHEADER = 192
+# the longest headword or inflected form that can be looked up, in characters
+MOBILABEL = 120
+MOBILANGUAGE = 0x18	# Romanian
+MOBITEXTHEAD = '<html><head><guide></guide></head><body>'
+MOBITEXTEND = '<mbp:pagebreak/></body></html>'
+MOBIPAGEBREAK = '<mbp:pagebreak/>'
+MOBIENTRY = re.compile(r'<idx:entry[^>]*>(.*?)</idx:entry>', re.S)
+MOBIORTH = re.compile(r'<idx:orth>(.*?)</idx:orth>', re.S)
+MOBIIFORM = re.compile(r'<idx:iform value="([^"]*)"')
+MOBIBODY = re.compile(r'<body>(.*)</body>', re.S)
+MOBISPACE = re.compile(r'\s*\n\s*')
+MOBIFLIS = 'FLIS\0\0\0\x08\0\x41\0\0\0\0\0\0\xff\xff\xff\xff\0\x01\0\x03\0\0\0\x03\0\0\0\x01\xff\xff\xff\xff'
+MOBIFCIS = 'FCIS\0\0\0\x14\0\0\0\x10\0\0\0\x01\0\0\0\0%s\0\0\0\0\0\0\0\x20\0\0\0\x08\0\x01\0\x01\0\0\0\0'
+MOBIEOF = '\xe9\x8e\r\n'
+# minimum number of seconds between two updates of the progress line
+PROGRESSINTERVAL = 0.5
+
+# with --pipeline, the windows of definitions read ahead of the rendering
+# and the chunks of the letter files waiting to be written
+PIPELINEDEPTH = 4
+
+# the other formats of --formats: the uncompressed size of the chunks of a dictzip file (.dict.dz),
+# the longest word of a StarDict index, and the digits of the offsets in a dictd index
+DICTZIPCHUNK = 58315
+STARDICTWORD = 255
+STARDICTASCIILOWER = dict((ord(c),ord(c.lower())) for c in string.ascii_uppercase)
+DICTDDIGITS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+DICTDINDENT = u'   '
+HTMLBREAK = re.compile(r'<(?:br|hr)[^>]*>|</(?:p|div|li)>', re.I)
+HTMLTAG = re.compile(r'<[^>]*>')
+HTMLENTITIES = HTMLParser()
+
+# --minify: the tags and the text of a definition, the attributes of a tag, the attributes never rendered
+# (the letter files have no stylesheet for the classes), the inline elements dropped when empty and the ones
+# left out when they have no attributes; the abbreviations are matched with the list of 'Abrevieri.html',
+# and the tags and abbreviations minified most recently are remembered
+MINIFYTOKEN = re.compile(r'<[^>]*>|[^<]+')
+MINIFYTAG = re.compile(r'<(/?)([A-Za-z][\w:-]*)((?:\s+[^\s"\'=/>]+(?:\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s"\'=<>`]+))?)*)\s*(/?)>$')
+MINIFYATTRIBUTE = re.compile(r'([^\s"\'=/>]+)(?:\s*=\s*("[^"]*"|\'[^\']*\'|[^\s"\'=<>`]+))?')
+MINIFYDROPPED = re.compile(r'(?:class|data-[\w-]+)$', re.I)
+MINIFYABBREVIATION = re.compile(r'<abbr\b[^>]*>[^<]*</abbr>', re.I)
+MINIFYSPACE = re.compile(r'[ \t\r\n\f]+')
+MINIFYINLINE = frozenset(['b','i','u','em','strong','sup','sub','small','big','span','abbr'])
+MINIFYUNWRAPPED = frozenset(['span','abbr'])
+MINIFYCACHE = 65536
+ABBREVIATIONITEM = re.compile(r'<li>\s*<b>(.*?):</b>(.*?)</li>', re.U | re.S)
+
+# the lookup index of --lookup-index: the header, the entries (file, offset, length and headword)
+# and the words of its records (an entry number and a bit telling an inflected form)
+LOOKUPMAGIC = 'DEXLKUP1'
+LOOKUPHEADER = '>8sLLLLLL'
+LOOKUPENTRY = '>HLLL'
+
+class LetterFile(object):
+	# collects the rendered entries of a letter and writes them, utf-8 encoded, in large chunks;
+	# when --max-file-size or --max-entries-per-file is reached the next entries go to a new file
+	def __init__(self, letter, filemask, container = None, state = None):
+		self.letter = letter
+		self.filemask = filemask
+		self.container = container
+		if state:
+			self.resume(state)
+		else:
+			self.parts = []
+			self.nextPart()
+	
+	def nextPart(self):
+		number = len(self.parts) + 1
+		filemask = self.filemask
+		if self.container:
+			filemask = os.path.basename(filemask)
+		if number == 1:
+			self.parts.append((self.letter,filemask + '_' + self.letter + '.html',self.letter))
+		else:
+			self.parts.append((self.letter + '_' + str(number),filemask + '_' + self.letter + '_' + str(number) + '.html',self.letter + ' (' + str(number) + ')'))
+		self.name = self.parts[-1][1]
+		if self.container:
+			self.file = self.container.open(self.name)
+		else:
+			self.file = io.open(self.name,'wb')
+		self.chunks = []
+		self.pending = 0
+		self.size = 0
+		self.entries = 0
+		self.write(EPUBFRAMESETTEMPLATEHEAD if self.container else FRAMESETTEMPLATEHEAD)
+	
+	def write(self, text):
+		self.writeBytes(text.encode('utf-8'))
+	
+	def writeBytes(self, data):
+		self.chunks.append(data)
+		self.pending += len(data)
+		self.size += len(data)
+		if self.pending >= LETTERBUFFER:
+			self.flush()
+	
+	def writeEntry(self, text):
+		start_time = metricsClock()
+		# the size of the file is in bytes, so the entry is encoded before it is measured
+		if self.container:
+			text = xhtmlEntry(text)
+		data = text.encode('utf-8')
+		if self.entries > 0:
+			if (args.max_entries_per_file and self.entries >= args.max_entries_per_file) or (args.max_file_size and self.size + len(data) + len(FRAMESETTEMPLATEEND.encode('utf-8')) > args.max_file_size * 1048576):
+				self.close()
+				self.nextPart()
+		self.entries += 1
+		offset = self.size
+		self.writeBytes(data)
+		addMetric('write',start_time)
+		return offset
+	
+	def flush(self):
+		writeData(self.file,''.join(self.chunks))
+		self.chunks = []
+		self.pending = 0
+	
+	def close(self):
+		self.write(FRAMESETTEMPLATEEND)
+		self.flush()
+		writeData(self.file,None)
+	
+	def checkpoint(self):
+		# the state saved by the checkpoints of the export, with the size of the files written so far
+		if self.chunks:
+			self.flush()
+		drainWrites()
+		if self.file and not self.file.closed:
+			self.file.flush()
+		return {"parts": self.parts, "size": self.size, "entries": self.entries, "lengths": [os.path.getsize(filename) for (itemid,filename,label) in self.parts]}
+	
+	def resume(self, state):
+		# the files are cut back to their size at the checkpoint, dropping what was written after it
+		self.parts = [tuple(part) for part in state["parts"]]
+		self.name = self.parts[-1][1]
+		self.file = None
+		self.chunks = []
+		self.pending = 0
+		self.size = state["size"]
+		self.entries = state["entries"]
+		for ((itemid,filename,label),length) in zip(self.parts,state["lengths"]):
+			f = io.open(filename,'r+b')
+			f.truncate(length)
+			f.close()
+	
+	def reopen(self):
+		# appends to the last file, when the letter comes back in the export order
+		if not self.container:
+			self.file = io.open(self.name,'ab')
+		else:
+			self.nextPart()	# the XHTML of the container is closed, so the letter goes on in a new file
+
+class LetterWriter(threading.Thread):
+	# the writer stage of --pipeline: writes (or, in the --epub container, deflates) the chunks of the letter files
+	# in the order they were queued; the queue holds at most PIPELINEDEPTH chunks, so the rendering waits for the disk
+	# when it gets too far ahead
+	def __init__(self):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.queue = Queue.Queue(PIPELINEDEPTH)
+		self.error = None
+		self.start()
+	
+	def run(self):
+		while True:
+			(f,data) = self.queue.get()
+			if f and not self.error:
+				try:
+					start_time = metricsClock()
+					if data is None:
+						f.close()
+					else:
+						f.write(data)
+					addMetric('disk',start_time)
+				except Exception:
+					self.error = sys.exc_info()
+			self.queue.task_done()
+			if not f:
+				return
+	
+	def put(self, f, data):
+		self.check()
+		self.queue.put((f,data))
+	
+	def drain(self):
+		self.queue.join()
+		self.check()
+	
+	def check(self):
+		# an error of the writer is raised again in the export
+		if self.error:
+			raise self.error[0], self.error[1], self.error[2]
+	
+	def stop(self):
+		self.queue.put((None,None))
+		self.join()
+
+def writeData(f,data):
+	# writes a chunk of a letter file, or closes it when there is no data; with --pipeline the writer thread does it
+	if letter_writer:
+		letter_writer.put(f,data)
+	elif data is None:
+		f.close()
+	else:
+		f.write(data)
+
+def drainWrites():
+	# waits for the chunks queued to the writer thread to be written, before the files are used
+	if letter_writer:
+		letter_writer.drain()
+
+class EpubMember(object):
+	# a letter file of the --epub container, deflated in memory as the entries are written
+	def __init__(self, name):
+		self.name = name
+		self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,zlib.DEFLATED,-15)
+		self.chunks = []
+		self.crc = 0
+		self.size = 0
+	
+	def write(self, data):
+		self.crc = zlib.crc32(data,self.crc)
+		self.size += len(data)
+		self.chunks.append(self.compressor.compress(data))
+	
+	def close(self):
+		pass	# written to the container by EpubContainer.commit()
+
+class EpubContainer(object):
+	# the EPUB 3 (zip) container the files of an edition are written to with --epub;
+	# the server sorts the letters with the same base letter (S and Ș, T and Ț...) together,
+	# so the letter files are committed to the zip once the export moves past their base letter
+	def __init__(self, filename, filemask):
+		self.filename = filename
+		self.zip = zipfile.ZipFile(filename,'w',zipfile.ZIP_DEFLATED)
+		self.zip.writestr(zipfile.ZipInfo('mimetype',time.localtime()[:6]),'application/epub+zip',zipfile.ZIP_STORED)
+		self.zip.writestr(zipfile.ZipInfo('META-INF/container.xml',time.localtime()[:6]),(EPUBCONTAINER % (os.path.basename(filemask) + '.opf')).encode('utf-8'))
+		self.pending = []
+	
+	def open(self, name):
+		member = EpubMember(name)
+		self.pending.append(member)
+		return member
+	
+	def commit(self):
+		drainWrites()
+		# the already deflated members are written as they are, with the header zipfile would write
+		for member in self.pending:
+			data = ''.join(member.chunks) + member.compressor.flush()
+			info = zipfile.ZipInfo(member.name,time.localtime()[:6])
+			info.compress_type = zipfile.ZIP_DEFLATED
+			info.CRC = member.crc & 0xffffffff
+			info.compress_size = len(data)
+			info.file_size = member.size
+			info.header_offset = self.zip.fp.tell()
+			self.zip.fp.write(info.FileHeader())
+			self.zip.fp.write(data)
+			self.zip.filelist.append(info)
+			self.zip.NameToInfo[info.filename] = info
+			member.chunks = []
+		self.pending = []
+	
+	def writestr(self, name, text):
+		self.zip.writestr(zipfile.ZipInfo(name,time.localtime()[:6]),text.encode('utf-8'),zipfile.ZIP_DEFLATED)
+	
+	def copy(self, filename):
+		path = findResource(filename,self.filename)
+		if path and filename.endswith('.html'):
+			with io.open(path,'r',encoding = 'utf-8') as f:
+				self.writestr(filename,xhtmlDocument(f.read()))
+		elif path:
+			self.zip.write(path,filename)
+		else:
+			print("\n'%s' was not found, so it is missing from '%s'..." % (filename,self.filename))
+	
+	def close(self):
+		self.commit()
+		for filename in EPUBRESOURCES:
+			self.copy(filename)
+		self.zip.close()
+
+def xhtmlEscape(text):
+	return XHTMLESCAPED.sub(lambda match: XHTMLESCAPE[match.group(0)],text)
+
+def xhtmlHtml(html):
+	# --epub: the HTML made well-formed XHTML, in one pass over the tags and the text: the names are lowercased,
+	# the attributes quoted (once each), the elements without content closed, the entities XML does not know
+	# replaced by their characters, the elements left open closed and the end tags of elements not open dropped
+	out = []
+	stack = []
+	for token in MINIFYTOKEN.findall(html):
+		if token[0] != u'<':
+			out.append(xhtmlEscape(HTMLENTITIES.unescape(token)))
+			continue
+		match = MINIFYTAG.match(token)
+		if not match:
+			if not token.startswith((u'<!',u'<?')):
+				out.append(xhtmlEscape(HTMLENTITIES.unescape(token)))
+			continue	# comments and declarations are left out
+		(closing,tagname,attributes,selfclosing) = match.groups()
+		name = tagname.lower()
+		if closing:
+			if name in stack:
+				while stack:
+					out.append(u'</%s>' % stack[-1])
+					if stack.pop() == name:
+						break
+			continue
+		values = collections.OrderedDict()
+		if name == 'html':
+			values['xmlns'] = XHTMLNAMESPACE
+		for (attribute,value) in MINIFYATTRIBUTE.findall(attributes):
+			attribute = attribute.lower()
+			if attribute not in values:
+				values[attribute] = HTMLENTITIES.unescape(value[1:-1] if value[:1] in u'"\'' else value) if value else attribute
+		tag = u'<' + name + u''.join(u' %s="%s"' % (attribute,xhtmlEscape(value)) for (attribute,value) in values.items())
+		if selfclosing or name in XHTMLEMPTY:
+			out.append(tag + u'/>')
+		else:
+			out.append(tag + u'>')
+			stack.append(name)
+	while stack:
+		out.append(u'</%s>' % stack.pop())
+	return u''.join(out)
+
+def xhtmlDocument(html):
+	# a whole page of the --epub container (the stats, the abbreviations), as XHTML
+	return u'<?xml version="1.0" encoding="utf-8"?>\n' + xhtmlHtml(html)
+
+def xhtmlEntry(text):
+	# an entry of the --epub container, whose definitions are already XHTML, with the <br> and <hr> of the templates closed
+	return XHTMLEMPTYTAG.sub(r'<\1/>',text)
+
+def findResource(filename,outputfile):
+	# the cover and the abbreviations page are taken from the directory of the output, or else of the script
+	for directory in [os.path.dirname(os.path.abspath(outputfile)),os.path.dirname(os.path.abspath(__file__))]:
+		if os.path.isfile(os.path.join(directory,filename)):
+			return os.path.join(directory,filename)
+	return None
+
+class Metrics(object):
+	# cumulative time and number of calls of each phase, counters and the slowest inflection lookups;
+	# the worker processes of --jobs send theirs back with each letter, to be merged
+	def __init__(self):
+		self.phases = {}
+		self.counts = {}
+		self.slowest = []
+		self.kindlegen = []
+	
+	def add(self, phase, seconds, calls = 1):
+		total = self.phases.setdefault(phase,[0.0,0])
+		total[0] += seconds
+		total[1] += calls
+	
+	def count(self, counter, value):
+		self.counts[counter] = self.counts.get(counter,0) + value
+	
+	def lookup(self, seconds, iddef, termen, diacriticsoption, forms):
+		# a heap of the slowest lookups, the fastest of them first
+		if len(self.slowest) < METRICSSLOWEST:
+			heapq.heappush(self.slowest,(seconds,iddef,termen,diacriticsoption,forms))
+		elif seconds > self.slowest[0][0]:
+			heapq.heapreplace(self.slowest,(seconds,iddef,termen,diacriticsoption,forms))
+	
+	def merge(self, other):
+		for phase in other.phases:
+			self.add(phase,*other.phases[phase])
+		for counter in other.counts:
+			self.count(counter,other.counts[counter])
+		for lookup in other.slowest:
+			self.lookup(*lookup)
+
+def metricsClock():
+	if metrics:
+		return time.time()
+	return 0
+
+def addMetric(phase,start_time):
+	if metrics:
+		metrics.add(phase,time.time() - start_time)
+
+def writeMetrics(filename,start_time):
+	report = {
+		"version": VERSION,
+		"date": time.strftime('%Y-%m-%d %H:%M:%S'),
+		"options": {"sources": source_list,"diacritics": [edition.diacritics for edition in editions],"group_entries": args.group_entries,"jobs": args.jobs,"stream": args.stream,"dump": bool(args.dump),"incremental": args.incremental,"pipeline": args.pipeline,"dedup": args.dedup,"client_sort": args.client_sort,"minify": args.minify,"size_budget": args.size_budget},
+		"duration": round(time.time() - start_time,3),
+		"peak_memory": peakMemory(),
+		"phases": dict((phase,{"seconds": round(seconds,3),"calls": calls}) for (phase,(seconds,calls)) in metrics.phases.items()),
+		"counts": dict(metrics.counts,queries = query_count,entries = entry_count,diacritic_cache_hits = diacritic_hits,diacritic_cache_misses = diacritic_misses,duplicates = duplicate_count,duplicate_bytes = duplicate_bytes,minify_input_bytes = minify_input,minify_output_bytes = minify_output),
+		"files": dict((edition.name,dict((filename,os.path.getsize(filename)) for (itemid,filename,label) in edition.parts if os.path.isfile(filename))) for edition in editions),
+		"slowest_inflection_lookups": [{"definition": iddef,"headword": termen,"diacritics": diacriticsoption,"forms": forms,"seconds": round(seconds,6)} for (seconds,iddef,termen,diacriticsoption,forms) in sorted(metrics.slowest,reverse = True)],
+		"kindlegen": metrics.kindlegen,
+	}
+	with open(filename,'w') as f:
+		json.dump(report,f,indent = 1,sort_keys = True)
+	print("\nMetrics saved in '%s'" % filename)
+
+def showProgress(i,total):
+	global progress_time
+	
+	if (i == total) or (time.time() - progress_time >= PROGRESSINTERVAL):
+		progress_time = time.time()
+		sys.stdout.write("\rExporting %s of %s..." % (i,total))
+
 def signal_handler(signal, frame):
 	global name
 	global to
 	
 	print('\n\nExport aborted!')
+	if name and os.path.isfile(name + '_CHECKPOINT.json'):
+		print("The export can be continued from its last checkpoint by running again with --resume.")
 	if name:
 		response = raw_input("Do you want to delete the temporary files (%s*.html)? [Y/n]: " % name).lower()
 		if (response == 'y') or (response == 'yes'):
 			if to:
 					to.close()
+			for edition in editions:
+				deleteFiles(edition.name, mobi = True)
 			deleteFiles(name, mobi = True)
 	sys.exit(0)
 
-def replaceWithCedilla(termen):
-	findreplace = [
-	(u"\u0218",u"\u015E"),
-	(u"\u0219",u"\u015F"),
-	(u"\u021A",u"\u0162"),
-	(u"\u021B",u"\u0163"),
-	]
-	for couple in findreplace:
-		termen = termen.replace(couple[0],couple[1])
-	return termen
-
-
-def isWithComma(termen):
-	chars = set(u"\u0218\u0219\u021A\u021B")
-	if any((c in chars) for c in termen):
-		return True
+def diacriticVariants(termen):
+	global diacritic_hits
+	global diacritic_misses
+	
+	# returns the form written with cedilla and the form without diacritics, both translated in a single pass;
+	# the most recently used forms are kept, as the same inflections come back over and over
+	variants = diacritic_cache.pop(termen,None)
+	if variants:
+		diacritic_hits += 1
 	else:
-		return False
+		diacritic_misses += 1
+		variants = (termen.translate(CEDILLATABLE),termen.translate(STRIPTABLE))
+		if len(diacritic_cache) >= DIACRITICSCACHE:
+			diacritic_cache.popitem(last = False)
+	diacritic_cache[termen] = variants
+	return variants
+
+def termVariants(termen):
+	#if the term contains comma it will export the term again but written with cedilla
+	cedilla = diacriticVariants(termen)[0]
+	if cedilla == termen:
+		return [termen]
+	if diacritics == 'cedilla':
+		return [cedilla]
+	if diacritics == 'comma':
+		return [termen]
+	return [cedilla,termen]
+
+class RomanianCollation(dict):
+	# the translation of the characters to their order in the Romanian alphabet, without case; the letters
+	# with cedilla are sorted as the ones with comma, and the other accented letters as their base letter
+	def __missing__(self, code):
+		c = unichr(code).lower()
+		c = {u"\u015f": u"\u0219", u"\u0163": u"\u021b"}.get(c,c)
+		if c not in ROMANIANALPHABET:
+			c = normalize('NFD',c)[0]
+		if c in ROMANIANALPHABET:
+			self[code] = unichr(0xE000 + ROMANIANALPHABET.index(c))	# after the digits and punctuation
+		else:
+			self[code] = unichr(code)
+		return self[code]
 
-def printInflections(inflections):
+romanian_collation = RomanianCollation()
+
+def romanianKey(termen):
+	return termen.translate(romanian_collation)
+
+def letterOf(termen):
+	# the letter file of a headword; with --client-sort, its letter in the Romanian alphabet (Ş goes with Ș)
+	if args.client_sort:
+		c = romanianKey(termen[0])
+		if u"\ue000" <= c < unichr(0xE000 + len(ROMANIANALPHABET)):
+			return ROMANIANALPHABET[ord(c) - 0xE000].upper()
+	return termen[0].upper()
+
+def renderInflections(inflections):
 	if len(inflections)>0:
-		to.write(IDXINFTEMPLATEHEAD)
-		for inflection in inflections:
-			to.write(IDXINFVALUETEMPLATE % inflection)
-		to.write(IDXINFTEMPLATEEND)
+		return IDXINFTEMPLATEHEAD + IDXINFVALUEHEAD + IDXINFVALUESEPARATOR.join(inflections) + IDXINFVALUEEND + IDXINFTEMPLATEEND
+	return u''
+
+def executeQuery(cursor,sql):
+	global query_count
+	
+	query_count += 1
+	cursor.execute(sql)
+
+def loadInflections(iddefs):
+	global inflection_cache
+	
+	inflection_cache = fetchInflections(iddefs)
 
-def inflectionsList(iddef):
+def fetchInflections(iddefs):
 	global cur2
+	
+	# fetches the inflections of a whole window of definitions with one query
+	inflections = dict((iddef,[]) for iddef in iddefs)
+	if len(iddefs) == 0:
+		return inflections
+	start_time = metricsClock()
+	executeQuery(cur2,"select distinct ldm.definitionId as iddef, formUtf8General as inflection from LexemDefinitionMap ldm join LexemModel lm on lm.lexemId = ldm.lexemId join InflectedForm inf on inf.lexemModelId = lm.id where ldm.definitionId in (%s)" % ','.join(str(iddef) for iddef in iddefs))
+	count = cur2.rowcount
+	for i in range(count):
+		inf = cur2.fetchone()
+		inflections[inf["iddef"]].append(inf["inflection"])
+	if metrics:
+		addMetric('inflections',start_time)
+		metrics.count('inflection_forms',count)
+	return inflections
+
+def inflectionVariants(forms,termen):
 	inflections = []
 	
-	cur2.execute("select distinct formUtf8General as inflection from Definition d join LexemDefinitionMap ldm on ldm.definitionid = d.id join LexemModel lm on lm.lexemid = ldm.lexemId join InflectedForm inf on inf.lexemModelId = lm.id where d.id = %s" % iddef)
-	
-	if cur2.rowcount>0:
-		for i in range(cur2.rowcount):
-			inf = cur2.fetchone()
-			inflection = inf["inflection"]
-			if isWithComma(inflection):
-				if (args.diacritics == 'cedilla') or (args.diacritics == 'both'):
-					inflections.append(replaceWithCedilla(inflection))
-				if (args.diacritics == 'comma') or (args.diacritics == 'both'):
-					inflections.append(inflection)
-			else:
-				inflections.append(inflection)
+	for inflection in forms:
+		inflections.extend(termVariants(inflection))
+	if diacritics == 'all':
+		# the forms without diacritics, as typed on most Kindle keyboards, are searchable too
+		seen = set(inflections)
+		seen.add(termen)
+		for form in [termen] + forms:
+			stripped = diacriticVariants(form)[1]
+			if stripped not in seen:
+				seen.add(stripped)
+				inflections.append(stripped)
 	return inflections
 
-def printTerm(iddef,termen,definition,source):
+def printTerm(termen,inflections,definition,source):
 	global to
+	global entry_count
 	
-	to.write(IDXTEMPLATEHEAD % (termen))
-	printInflections(inflectionsList(iddef))
-	to.write(IDXTEMPLATEEND % (definition,source))
+	entry_count += 1
+	start_time = metricsClock()
+	entry = IDXTEMPLATEHEAD % (termen) + renderInflections(inflections) + IDXTEMPLATEEND % (definition,source)
+	addMetric('render',start_time)
+	offset = to.writeEntry(entry)
+	if lookup:
+		lookup.addEntry(termen,inflections,to.name,offset,to.size - offset)
+
+def printGroupedTerm(termen,inflections,definitions):
+	global to
+	global entry_count
+	
+	entry_count += 1
+	start_time = metricsClock()
+	entry = IDXTEMPLATEHEAD % (termen) + renderInflections(inflections) + IDXGROUPTEMPLATEHEAD + IDXGROUPSEPARATORTEMPLATE.join(IDXGROUPVALUETEMPLATE % (definition,source) for (definition,source) in definitions) + IDXGROUPTEMPLATEEND
+	addMetric('render',start_time)
+	offset = to.writeEntry(entry)
+	if lookup:
+		lookup.addEntry(termen,inflections,to.name,offset,to.size - offset)
+
+def printArticle(variants,inflections,definitions):
+	# the other formats (--formats) get a single article for the variants of the headword,
+	# found by the other variants and the inflected forms too
+	if not writers:
+		return
+	start_time = metricsClock()
+	headword = variants[-1]
+	synonyms = []
+	seen = set([headword])
+	for form in variants + inflections:
+		if form not in seen:
+			seen.add(form)
+			synonyms.append(form)
+	html = u'<br/>'.join(u'%s<br/><i>Sursa: %s</i>' % (definition,source) for (definition,source) in definitions)
+	for writer in writers:
+		writer.addArticle(headword,synonyms,html)
+	addMetric('formats',start_time)
+
+def printGroupedDefinitions():
+	# writes one entry for all the definitions of a headword, with the union of their inflections
+	if len(pending_definitions) == 0:
+		return
+	dterm = pending_definitions[0][0]["lexicon"]
+	start_time = metricsClock()
+	forms = mergeForms([rowforms for (row,rowforms) in pending_definitions])
+	inflections = inflectionVariants(forms,dterm)
+	variants = termVariants(dterm)
+	if metrics:
+		seconds = time.time() - start_time
+		metrics.add('diacritics',seconds)
+		metrics.lookup(seconds,pending_definitions[0][0]["id"],dterm,diacritics,len(inflections))
+	definitions = [(row["htmlRep"],row["source"]) for (row,rowforms) in pending_definitions]
+	del pending_definitions[:]
+	
+	for termen in variants:
+		printGroupedTerm(termen,inflections,definitions)
+	printArticle(variants,inflections,definitions)
+
+def mergeForms(formlists):
+	# the union of the inflected forms of several definitions, in the order they come
+	forms = []
+	seen = set()
+	for rowforms in formlists:
+		for form in rowforms:
+			if form not in seen:
+				seen.add(form)
+				forms.append(form)
+	return forms
+
+def dedupDefinitions():
+	global duplicate_count
+	global duplicate_bytes
+	
+	# the definitions of the headword with the same text, but for the spaces, are kept once (found by the digest
+	# of the normalized text), listing the sources and with the inflections of all of them; the rows are shared
+	# by the editions, so the merged ones are copies, and the duplicates are counted in the first edition only
+	counted = pending_definitions is editions[0].pending
+	merged = collections.OrderedDict()
+	for (row,forms) in pending_definitions:
+		digest = hashlib.sha1(DEDUPSPACE.sub(u' ',row["htmlRep"]).strip().encode('utf-8')).digest()
+		if digest not in merged:
+			merged[digest] = (row,[forms])
+			continue
+		(first,formlists) = merged[digest]
+		merged[digest] = (dict(first,source = first["source"] + u', ' + row["source"]),formlists + [forms])
+		if counted:
+			duplicate_count += 1
+			duplicate_bytes += len(row["htmlRep"].encode('utf-8'))
+	pending_definitions[:] = [(row,mergeForms(formlists)) for (row,formlists) in merged.values()]
+
+def printPendingDefinitions():
+	# the definitions of the headword kept by --group-entries or --dedup
+	if args.dedup:
+		dedupDefinitions()
+	if args.group_entries:
+		printGroupedDefinitions()
+	else:
+		for (row,forms) in pending_definitions:
+			printSingleDefinition(row,forms)
+		del pending_definitions[:]
+
+def finishLetterFile():
+	global to
+	
+	printPendingDefinitions()
+	to.close()
 
 def deleteFile(filename):
 	try:
@@ -310,178 +1131,1992 @@ def deleteFiles(filemask,mobi):
 	deleteFile(filemask + '_TOC.xhtml')
 	deleteFile(filemask + '_STATS.html')
 	deleteFile(filemask + '.opf')
+	deleteFile(filemask + '.epub')
+	deleteFile(filemask + '_BUILD.json')
+	deleteFile(filemask + '_CHECKPOINT.json')
 	if mobi:
 		deleteFile(filemask + '.mobi')
+		deleteFile(filemask + '_kindlegen.log')
+		for extension in ['.ifo','.idx','.syn','.dict.dz','_dictd.index','_dictd.dict.dz','_LOOKUP.idx']:
+			deleteFile(filemask + extension)
 
-def deleteTemporaryFiles():
+def deleteTemporaryFiles(filemask):
 	response = 'n'
 	if args.interactive:
-		response = raw_input("\nDo you want to delete the temporary files (%s*.html and %s.opf) [Y/n]?: " % (name,name)).lower() or 'y'
+		response = raw_input("\nDo you want to delete the temporary files (%s*.html and %s.opf or %s.epub) [Y/n]?: " % (filemask,filemask,filemask)).lower() or 'y'
 	if (args.temp_files) or ((response == 'y') or (response == 'yes')):
-		deleteFiles(name, mobi = False)
+		deleteFiles(filemask, mobi = False)
 		print("Done removing files.")
 
-def tryConnect():
-	global mysql_server
-	global mysql_port
-	global mysql_user
-	global mysql_passwd
-	global mysql_db
-	global conn
-	global cur
-	global cur2
+# tables (and columns) read from a DEXonline SQL dump by --dump
+DUMPTABLES = {
+	'Source': [('id','integer primary key'),('name','text'),('year','text'),('canDistribute','integer')],
+	'Definition': [('id','integer primary key'),('sourceId','integer'),('lexicon','text collate general_ci'),('htmlRep','text'),('status','integer'),('modDate','integer')],
+	'LexemDefinitionMap': [('lexemId','integer'),('definitionId','integer')],
+	'LexemModel': [('id','integer primary key'),('lexemId','integer')],
+	'InflectedForm': [('lexemModelId','integer'),('formUtf8General','text')],
+}
+
+DUMPINDEXES = [
+	"create index Definition_sourceId on Definition (sourceId, lexicon)",
+	"create index LexemDefinitionMap_definitionId on LexemDefinitionMap (definitionId)",
+	"create index LexemModel_lexemId on LexemModel (lexemId)",
+	"create index InflectedForm_lexemModelId on InflectedForm (lexemModelId)",
+]
+
+DUMPCREATE = re.compile(r"^CREATE TABLE `(\w+)`")
+DUMPCOLUMN = re.compile(r"^\s+`(\w+)`")
+DUMPINSERT = re.compile(r"^INSERT INTO `(\w+)`\s*(?:\(([^)]*)\)\s*)?VALUES\s*", re.I)
+DUMPVALUE = re.compile(r"\s*(?:'((?:[^'\\]+|\\.|'')*)'|(NULL)|([^,)]*))\s*([,)])", re.S)
+DUMPESCAPE = re.compile(r"\\(.)|''", re.S)
+DUMPESCAPES = {'0': u'\0', 'b': u'\b', 'n': u'\n', 'r': u'\r', 't': u'\t', 'Z': u'\x1a'}
+
+def generalCiKey(termen):
+	# approximates the utf8_general_ci collation of the MySQL server: case and accent insensitive
+	return u''.join(c for c in normalize('NFD',termen) if not combining(c)).upper()
 
+def generalCiCompare(a,b):
+	# sqlite hands the values to the collation as utf-8 encoded strings
+	return cmp(generalCiKey(a.decode('utf-8')),generalCiKey(b.decode('utf-8')))
+
+def unescapeDumpValue(value):
+	return DUMPESCAPE.sub(lambda m: DUMPESCAPES.get(m.group(1),m.group(1)) if m.group(1) else u"'",value)
+
+def dumpRows(values):
+	# yields the rows of the VALUES (...),(...) part of an INSERT statement
+	pos = 0
+	while True:
+		pos = values.find('(',pos)
+		if pos < 0:
+			return
+		pos += 1
+		row = []
+		while True:
+			m = DUMPVALUE.match(values,pos)
+			if not m:
+				raise ValueError("Malformed INSERT statement near: %s" % values[pos:pos+50])
+			if m.group(1) is not None:
+				row.append(unescapeDumpValue(m.group(1)))
+			elif m.group(2):
+				row.append(None)
+			else:
+				row.append(m.group(3).strip())
+			pos = m.end()
+			if m.group(4) == ')':
+				break
+		yield row
+
+def dumpStatements(filename):
+	# yields the statements of the dump, joining the ones spread on several lines
+	if filename.endswith('.gz'):
+		dump = gzip.open(filename,'rb')
+	else:
+		dump = open(filename,'rb')
+	statement = ''
+	for line in dump:
+		if statement:
+			statement += line
+		elif line.startswith('INSERT INTO') or line.startswith('CREATE TABLE'):
+			statement = line
+		else:
+			continue
+		if statement.rstrip().endswith(';'):
+			yield statement.decode('utf-8','replace')
+			statement = ''
+	dump.close()
+
+def indexDump(filename):
+	# loads the tables needed for the export from a SQL dump into an on-disk sqlite index
+	start_time = time.time()
+	fd, indexname = tempfile.mkstemp(prefix=os.path.basename(name) + '_dump_',suffix='.sqlite',dir=os.path.dirname(os.path.abspath(name)))
+	os.close(fd)
+	atexit.register(deleteFile,indexname)
+	
+	db = sqlite3.connect(indexname)
+	db.create_collation('general_ci',generalCiCompare)
+	db.execute("pragma synchronous = off")
+	db.execute("pragma journal_mode = off")
+	for table in DUMPTABLES:
+		db.execute("create table %s (%s)" % (table,', '.join('%s %s' % column for column in DUMPTABLES[table])))
+	
+	dumpcolumns = {}
+	table = ''
+	rowcount = 0
+	for statement in dumpStatements(filename):
+		m = DUMPCREATE.match(statement)
+		if m:
+			# remember the column order of the tables that are needed
+			table = m.group(1)
+			if table in DUMPTABLES:
+				dumpcolumns[table] = []
+				for line in statement.splitlines()[1:]:
+					column = DUMPCOLUMN.match(line)
+					if not column:
+						break
+					dumpcolumns[table].append(column.group(1))
+			continue
+		m = DUMPINSERT.match(statement)
+		if not m or m.group(1) not in DUMPTABLES:
+			continue
+		table = m.group(1)
+		if m.group(2):
+			columns = [column.strip(' `') for column in m.group(2).split(',')]
+		else:
+			columns = dumpcolumns.get(table,[])
+		try:
+			positions = [columns.index(column) for (column,coltype) in DUMPTABLES[table]]
+		except ValueError:
+			print("\nThe dump does not contain the columns %s for table '%s'..." % (', '.join(column for (column,coltype) in DUMPTABLES[table]),table))
+			sys.exit()
+		rows = (tuple(row[position] for position in positions) for row in dumpRows(statement[m.end():]))
+		if table == 'Definition':
+			# only the active definitions are ever exported
+			rows = (row for row in rows if row[4] == '0')
+		cursor = db.executemany("insert into %s values (%s)" % (table,','.join('?' * len(positions))),rows)
+		rowcount += cursor.rowcount
+		sys.stdout.write("\rIndexing dump: %s rows..." % rowcount)
+	
+	for index in DUMPINDEXES:
+		db.execute(index)
+	db.commit()
+	db.close()
+	end_time = time.time()
+	print("\nDump indexed in %s" % time.strftime('%H:%M:%S',time.gmtime((end_time - start_time))))
+	return indexname
+
+class DumpCursor(object):
+	# cursor over the dump index returning rows as dictionaries, like pymysql's DictCursor
+	def __init__(self, db):
+		self.db = db
+		self.cursor = db.cursor()
+		self.columns = []
+		self.sql = ''
+		self.count = None
+	
+	def execute(self, sql):
+		self.sql = sql
+		self.count = None
+		self.cursor.execute(sql)
+		self.columns = [column[0] for column in self.cursor.description or []]
+	
+	@property
+	def rowcount(self):
+		# counted separately, so the rows themselves are never held in memory
+		if self.count is None:
+			self.count = self.db.execute("select count(*) from (%s)" % self.sql).fetchone()[0]
+		return self.count
+	
+	def fetchone(self):
+		row = self.cursor.fetchone()
+		if row is None:
+			return None
+		return dict(zip(self.columns,row))
+	
+	def fetchmany(self, size):
+		return [dict(zip(self.columns,row)) for row in self.cursor.fetchmany(size)]
+	
+	def close(self):
+		self.cursor.close()
+
+class DumpConnection(object):
+	# stands in for a pymysql connection when the definitions are read from a SQL dump
+	def __init__(self, indexname):
+		# used by one thread at a time, but with --pipeline not always by the one that opened it
+		self.db = sqlite3.connect(indexname,check_same_thread = False)
+		self.db.create_collation('general_ci',generalCiCompare)
+		self.db.create_function('concat',-1,lambda *values: u''.join(unicode(value) for value in values))
+	
+	def cursor(self):
+		return DumpCursor(self.db)
+	
+	def escape(self, value):
+		# quotes a string for the SQL of the export, as pymysql's escape does
+		return u"'" + value.replace(u"'",u"''") + u"'"
+	
+	def close(self):
+		self.db.close()
+
+def openCursor(connection,unbuffered = False):
+	if args.dump:
+		return connection.cursor()
+	if unbuffered:
+		return connection.cursor(pymysql.cursors.SSDictCursor)
+	return connection.cursor(pymysql.cursors.DictCursor)
+
+def openConnection():
+	global dump_index
+	
+	if args.dump:
+		if not dump_index:
+			dump_index = indexDump(args.dump)
+		return DumpConnection(dump_index)
+	if not pymysql:
+		print("\nThe PyMySql package is needed to connect to the MySQL server (pip install pymysql)...")
+		sys.exit()
 	try:
-		conn = pymysql.connect(host=mysql_server, port=mysql_port, user=mysql_user, passwd=mysql_passwd, db=mysql_db,charset='utf8')
+		return pymysql.connect(host=mysql_server, port=mysql_port, user=mysql_user, passwd=mysql_passwd, db=mysql_db,charset='utf8')
 	except pymysql.OperationalError as e:
 		print('\nGot error {!r}, errno is {}'.format(e, e.args[0]))
 		print("\nCould not connect to MySQL server using the parameters you entered.\nPlease make sure that the server is running and try again...")
 		sys.exit()
-	cur = conn.cursor(pymysql.cursors.DictCursor)
-	cur2 = conn.cursor(pymysql.cursors.DictCursor)
 
-
-def exportDictionaryFiles():
-	global to
+def tryConnect():
+	global conn
+	global conn2
 	global cur
+	global cur2
+
+	conn = openConnection()
+	cur = openCursor(conn)
+	if args.stream:
+		# while the definitions are streamed the first connection is busy,
+		# so the inflections are read using a second one
+		conn2 = openConnection()
+		cur2 = openCursor(conn2)
+	else:
+		cur2 = openCursor(conn)
+
+def peakMemory():
+	if not resource:
+		return 'n/a'
+	maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':
+		maxrss = maxrss / 1024	# bytes on Mac OS X, kilobytes on Linux
+	return '%.1f MB' % (maxrss / 1024.0)
+
+def printDefinition(row):
+	forms = inflection_cache.get(row["id"],[])
+	if budget:
+		if row["lexicon"] in budget.dropped:
+			return
+		if row["lexicon"] in budget.bare:
+			forms = []
+	if args.group_entries or args.dedup:
+		# the rows come ordered by lexicon, so the definitions of a headword are consecutive
+		if len(pending_definitions) > 0 and pending_definitions[0][0]["lexicon"] != row["lexicon"]:
+			printPendingDefinitions()
+		pending_definitions.append((row,forms))
+		return
+	printSingleDefinition(row,forms)
+
+def loadAbbreviations():
+	# the meaning of each abbreviation of 'Abrevieri.html', by its text without spaces, in lower case
+	table = {}
+	filename = findResource('Abrevieri.html',name)
+	if filename:
+		with io.open(filename,'r',encoding = 'utf-8') as f:
+			for (abbreviation,meaning) in ABBREVIATIONITEM.findall(f.read()):
+				table[abbreviationKey(htmlText(abbreviation))] = abbreviationKey(htmlText(meaning),u' ')
+	return table
+
+def abbreviationKey(text,space = u''):
+	return MINIFYSPACE.sub(space,HTMLENTITIES.unescape(text)).strip().lower()
+
+def minifyTag(tag):
+	# (closing tag, name, minified tag); the name is None for what is not a tag (comments) and
+	# the minified tag is None for the elements to leave out
+	match = MINIFYTAG.match(tag)
+	if not match:
+		return (False,None,tag)
+	(closing,tagname,attributes,selfclosing) = match.groups()
+	name = tagname.lower()
+	if closing:
+		return (True,name,u'</%s>' % tagname)
+	attributes = [(attribute,value) for (attribute,value) in MINIFYATTRIBUTE.findall(attributes) if not MINIFYDROPPED.match(attribute)]
+	if not attributes and name in MINIFYUNWRAPPED:
+		return (False,name,None)
+	return (False,name,u'<%s%s%s>' % (tagname,u''.join(u' %s=%s' % (attribute,value) if value else u' ' + attribute for (attribute,value) in attributes),u'/' if selfclosing else u''))
+
+def minifyAbbreviation(abbreviation):
+	# an abbreviation with the meaning it has in 'Abrevieri.html' (in the book) does not need its title
+	(tag,text) = abbreviation[:-len(u'</abbr>')].split(u'>',1)
+	match = MINIFYTAG.match(tag + u'>')
+	if not match:
+		return abbreviation
+	attributes = []
+	for (attribute,value) in MINIFYATTRIBUTE.findall(match.group(3)):
+		if MINIFYDROPPED.match(attribute):
+			continue
+		if attribute.lower() == 'title' and abbreviations.get(abbreviationKey(text)) == abbreviationKey(value.strip(u'"\''),u' '):
+			continue
+		attributes.append(u' %s=%s' % (attribute,value) if value else u' ' + attribute)
+	text = MINIFYSPACE.sub(u' ',text)
+	if not attributes:
+		return text
+	return u'<%s%s>%s</abbr>' % (tag[1:].split()[0],u''.join(attributes),text)
+
+def minifyFragment(fragment,minify):
+	# the tags and abbreviations come back over and over, so the most recently used are kept
+	minified = minify_cache.pop(fragment,None)
+	if minified is None:
+		minified = minify(fragment)
+		if len(minify_cache) >= MINIFYCACHE:
+			minify_cache.popitem(last = False)
+	minify_cache[fragment] = minified
+	return minified
+
+def minifyHtml(html):
+	# one pass over the tags and the text: the runs of spaces become one space, the attributes never rendered
+	# are dropped, the spans left without attributes are left out, the empty inline elements are dropped and
+	# the same inline element closed and opened again is joined; the text rendered stays the same
+	html = MINIFYABBREVIATION.sub(lambda match: minifyFragment(match.group(0),minifyAbbreviation),html)
+	out = []
+	stack = []
+	closed = None
+	for token in MINIFYTOKEN.findall(html):
+		if token[0] != u'<':
+			token = MINIFYSPACE.sub(u' ',token)
+			if out and out[-1][0] != u'<':
+				# the text of an element left out
+				if token[0] == u' ' and out[-1][-1] == u' ':
+					token = token[1:]
+				out[-1] = out[-1] + token
+			else:
+				out.append(token)
+			continue
+		(closing,name,tag) = minifyFragment(token,minifyTag)
+		if name not in MINIFYINLINE or (tag and tag.endswith(u'/>')):
+			out.append(tag)
+		elif not closing:
+			if closed and closed == (len(out),tag):
+				out.pop()
+			elif tag is not None:
+				out.append(tag)
+			stack.append((name,tag))
+		elif stack and stack[-1][0] == name:
+			(name,opening) = stack.pop()
+			if opening is None:
+				continue
+			if out and out[-1] == opening:
+				out.pop()
+				continue
+			out.append(tag)
+			closed = (len(out),opening)
+		else:
+			out.append(token)	# not opened, as written
+	return u''.join(out)
+
+def minifyDefinition(row):
+	global minify_input
+	global minify_output
+	global minify_time
+	global abbreviations
 	
+	# --minify: the definition is compacted once, before it is rendered for the editions
+	if abbreviations is None:
+		abbreviations = loadAbbreviations()
 	start_time = time.time()
-	cur.execute("select d.id,lexicon,replace(htmlRep,'\n','') as htmlRep, concat(s.name,' ',s.year) as source from Definition d join Source s on d.sourceId = s.id where s.id in (%s) and lexicon <>'' and status = 0 order by lexicon asc, s.id desc" % ','.join(source_list))
+	html = minifyHtml(row["htmlRep"])
+	seconds = time.time() - start_time
+	minify_time += seconds
+	if metrics:
+		metrics.add('minify',seconds)
+	minify_input += len(row["htmlRep"].encode('utf-8'))
+	minify_output += len(html.encode('utf-8'))
+	row["htmlRep"] = html
+
+def printSingleDefinition(row,forms):
+	did = row["id"]
+	dterm = row["lexicon"]
+	ddef = row["htmlRep"]
+	dsrc = row["source"]
+	
+	start_time = metricsClock()
+	inflections = inflectionVariants(forms,dterm)
+	variants = termVariants(dterm)
+	if metrics:
+		seconds = time.time() - start_time
+		metrics.add('diacritics',seconds)
+		metrics.lookup(seconds,did,dterm,diacritics,len(inflections))
+	for termen in variants:
+		printTerm(termen,inflections,ddef,dsrc)
+	printArticle(variants,inflections,[(ddef,dsrc)])
+
+class Edition(object):
+	# one set of output files (letter files, OPF, TOC and stats); with --editions the same
+	# definitions are exported to several of them, each with its own diacritics option
+	def __init__(self, filemask, diacriticsoption):
+		self.name = filemask
+		self.diacritics = diacriticsoption
+		self.to = False
+		self.letterfiles = {}
+		self.letters = []
+		self.parts = []
+		self.pending = []
+		self.container = None
+		self.writers = []
+		self.lookup = None
+	
+	def activate(self):
+		global diacritics
+		global to
+		global pending_definitions
+		global writers
+		global lookup
+		
+		# the entries are printed to the current letter file of the active edition
+		diacritics = self.diacritics
+		to = self.to
+		pending_definitions = self.pending
+		writers = self.writers
+		lookup = self.lookup
+	
+	def startLetter(self, letter):
+		previous = self.to
+		self.closeLetter()
+		if args.formats and not self.writers:
+			self.writers[:] = [FORMATWRITERS[option](self.name) for option in args.formats]
+		if args.lookup_index and not self.lookup:
+			self.lookup = LookupWriter(self.name + '_LOOKUP.idx')
+		if args.epub:
+			if not self.container:
+				self.container = EpubContainer(self.name + '.epub',self.name)
+			elif generalCiKey(previous.letter) != generalCiKey(letter):
+				self.container.commit()
+		if letter in self.letterfiles:
+			# appends to the letter file, when the letter comes back in the export order
+			self.to = self.letterfiles[letter]
+			self.to.reopen()
+		else:
+			self.to = LetterFile(letter,self.name,self.container)
+			self.letterfiles[letter] = self.to
+			self.letters.append(letter)
+	
+	def closeLetter(self):
+		if self.to:
+			self.activate()
+			finishLetterFile()
+			self.to = False
+	
+	def checkpoint(self):
+		# the letter files, the current one and the definitions of --group-entries not written yet
+		return {
+			"letters": self.letters,
+			"letterfiles": dict((letter,self.letterfiles[letter].checkpoint()) for letter in self.letters),
+			"current": self.to.letter if self.to else None,
+			"pending": self.pending,
+		}
 	
-	if cur.rowcount == 0:
+	def resume(self, state):
+		self.letters = state["letters"]
+		for letter in self.letters:
+			self.letterfiles[letter] = LetterFile(letter,self.name,state = state["letterfiles"][letter])
+		self.pending[:] = [tuple(definition) for definition in state["pending"]]
+		if state["current"]:
+			self.to = self.letterfiles[state["current"]]
+			self.to.reopen()
+
+def openEditions():
+	global editions
+	
+	if args.editions:
+		editions = [Edition(name + '_' + option,option) for option in args.editions]
+	else:
+		editions = [Edition(name,args.diacritics)]
+
+def exportLetters(checkpoint = None):
+	global inflection_cache
+	global letter_writer
+	
+	executeQuery(cur,"select count(*) as defcount " + DEFINITIONSFILTER % ','.join(source_list))
+	total = cur.fetchone()["defcount"]
+	if total == 0:
 		print("Managed to retrieve 0 definitions from dictionary...\nSomething was wrong...")
 		sys.exit()
 	
-	manifest = ''
-	spine = ''
 	letter = ''
-	toc = ''
-	to = False
-	
-	for i in range(cur.rowcount):
-		row = cur.fetchone()
+	i = 0
+	after = ''
+	if checkpoint:
+		(letter,i) = (checkpoint["letter"],checkpoint["definitions"])
+		if not args.client_sort:
+			after = definitionsAfter(checkpoint["key"])
+		for (edition,state) in zip(editions,checkpoint["editions"]):
+			edition.resume(state)
+		for counter in COUNTERS:
+			globals()[counter] = checkpoint["counters"][counter]
+		print("\nResuming the export after %s of %s definitions..." % (i,total))
 	
-		did = row["id"]
-		dterm = row["lexicon"]
-		ddef = row["htmlRep"]
-		dsrc = row["source"]
+	# with --pipeline the definitions are read by another thread and the letter files written by a third one,
+	# while this one renders the entries in the same order
+	if args.client_sort:
+		windows = readSortedDefinitions(i)
+	else:
+		windows = readDefinitions(after)
+	reader = None
+	if args.pipeline:
+		reader = DefinitionReader(windows)
+		windows = reader.windows()
+		letter_writer = LetterWriter()
+	try:
+		for (rows,inflections) in windows:
+			if rows is None:
+				# the end of a chunk, with the key of its last definition
+				if not args.epub:
+					writeCheckpoint(inflections,i,letter)
+				continue
+			inflection_cache = inflections
+			
+			for row in rows:
+				i += 1
+				dterm = row["lexicon"]
+				
+				if letter != letterOf(dterm):
+					letter = letterOf(dterm)
+					for edition in editions:
+						edition.startLetter(letter)
+				
+				showProgress(i,total)
+				if args.minify:
+					minifyDefinition(row)
+				if args.epub:
+					row["htmlRep"] = xhtmlHtml(row["htmlRep"])
+				for edition in editions:
+					edition.activate()
+					printDefinition(row)
 		
-		if letter != dterm[0].upper():
-			letter = dterm[0].upper()
-			if to:
-				to.write(FRAMESETTEMPLATEEND)
-				to.close()
-			filename = name + '_' + letter + '.html'
-			if os.path.isfile(filename):
-				to = codecs.open(filename, "a","utf-8")
-			else:
-				to = codecs.open(filename, "w","utf-8")
-				to.write(FRAMESETTEMPLATEHEAD)
-				manifest = manifest + '\t\t<item id="' + letter + '" href="' + to.name + '" media-type="text/x-oeb1-document"/>\n'
-				spine = spine + '\t\t<itemref idref="' + letter + '"/>\n'
-				toc = toc + '\n\t\t\t\t\t\t<li><a href="' + to.name + '">' + letter + '</a></li>'
+		for edition in editions:
+			edition.closeLetter()
+			edition.parts = [part for letter in edition.letters for part in edition.letterfiles[letter].parts]
+		drainWrites()
+	finally:
+		if reader:
+			reader.stop()
+			letter_writer.stop()
+			letter_writer = None
+	deleteFile(name + '_CHECKPOINT.json')
+	return total
+
+def readDefinitions(after):
+	global cur
+	
+	# yields the definitions in windows of INFLECTION_WINDOW, with their inflections, read by a single ordered query;
+	# each DEFINITIONSCHUNK definitions are followed by (None,key), so an interrupted export can be continued
+	# from the last checkpoint by --resume; when the connection to the server drops, the query is run again
+	# starting after the last definition read
+	count = 0
+	key = None
+	retried = None
+	while True:
+		try:
+			cur.close()
+			cur = openCursor(conn,unbuffered = args.stream)
+			start_time = metricsClock()
+			executeQuery(cur,"select " + DEFINITIONCOLUMNS + " " + DEFINITIONSFILTER % ','.join(source_list) + after + definitionsOrder())
+			addMetric('definitions',start_time)
+			
+			while True:
+				start_time = metricsClock()
+				rows = cur.fetchmany(min(INFLECTION_WINDOW,DEFINITIONSCHUNK - count % DEFINITIONSCHUNK))
+				addMetric('definitions',start_time)
+				if not rows:
+					return
+				yield (rows,fetchInflections([row["id"] for row in rows]))
+				count += len(rows)
+				key = (rows[-1]["lexicon"],rows[-1]["sourceId"],rows[-1]["id"])
+				if count % DEFINITIONSCHUNK == 0:
+					yield (None,key)
+		except DROPPEDCONNECTION:
+			# reconnects once for each position, so a server that keeps failing stops the export
+			if args.dump or retried == count:
+				raise
+			retried = count
+			print("\nThe connection to the server dropped, reading again after %s definitions..." % count)
+			conn.ping(True)
+			cur = openCursor(conn)	# the cursor of the dropped connection can not be closed
+			if key:
+				after = definitionsAfter(key)
+
+def readSortedDefinitions(skip):
+	# the windows of readDefinitions with --client-sort, after the first definitions (exported before a --resume);
+	# each DEFINITIONSCHUNK definitions are followed by (None,number of definitions)
+	count = 0
+	window = []
+	for row in sortedRows(DEFINITIONCOLUMNS):
+		count += 1
+		if count <= skip:
+			continue
+		window.append(row)
+		if len(window) == INFLECTION_WINDOW or count % DEFINITIONSCHUNK == 0:
+			yield (window,fetchInflections([row["id"] for row in window]))
+			window = []
+		if count % DEFINITIONSCHUNK == 0:
+			yield (None,count)
+	if window:
+		yield (window,fetchInflections([row["id"] for row in window]))
+
+def sortedRows(columns):
+	global cur
+	
+	# --client-sort: the rows are read in chunks of their primary key, which the server does not need to sort,
+	# and sorted here by their Romanian collation key (then as the server does) with an external merge sort:
+	# runs of SORTRUN bytes are sorted in memory and written to temporary files, and then merged
+	runs = []
+	run = []
+	size = 0
+	last = 0
+	directory = os.path.dirname(os.path.abspath(name))
+	while True:
+		cur.close()
+		cur = openCursor(conn,unbuffered = args.stream)
+		start_time = metricsClock()
+		executeQuery(cur,"select " + columns + " " + DEFINITIONSFILTER % ','.join(source_list) + " and d.id > %d order by d.id limit %d" % (last,DEFINITIONSCHUNK))
+		addMetric('definitions',start_time)
+		count = 0
+		while True:
+			start_time = metricsClock()
+			rows = cur.fetchmany(INFLECTION_WINDOW)
+			addMetric('definitions',start_time)
+			if not rows:
+				break
+			start_time = metricsClock()
+			for row in rows:
+				run.append((romanianKey(row["lexicon"]),row["lexicon"],-row["sourceId"],row["id"],row))
+				size += len(row["lexicon"]) + len(row.get("htmlRep",u''))
+			if size >= SORTRUN:
+				runs.append(writeRun(run,directory))
+				run = []
+				size = 0
+			addMetric('sort',start_time)
+			count += len(rows)
+			last = rows[-1]["id"]
+		if count < DEFINITIONSCHUNK:
+			break
+	
+	start_time = metricsClock()
+	run.sort()
+	addMetric('sort',start_time)
+	if metrics:
+		metrics.count('sort_runs',len(runs) + 1)
+	if not runs:
+		for item in run:
+			yield item[-1]
+		return
+	runs.append(writeRun(run,directory))
+	del run
+	for item in heapq.merge(*[readRun(f) for f in runs]):
+		yield item[-1]
+
+def writeRun(run,directory):
+	run.sort()
+	f = tempfile.TemporaryFile(dir=directory)
+	for item in run:
+		marshal.dump(item,f)
+	f.seek(0)
+	return f
+
+def readRun(f):
+	while True:
+		try:
+			yield marshal.load(f)
+		except EOFError:
+			break
+	f.close()
+
+class DefinitionReader(threading.Thread):
+	# the reader stage of --pipeline: runs readDefinitions ahead of the rendering, keeping at most
+	# PIPELINEDEPTH windows of definitions in the queue, so the reading waits when the rendering is behind
+	def __init__(self, windows):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.source = windows
+		self.queue = Queue.Queue(PIPELINEDEPTH)
+		self.stopped = False
+		self.start()
+	
+	def run(self):
+		try:
+			for window in self.source:
+				if not self.put(('window',window)):
+					return
+			self.put(('end',None))
+		except Exception:
+			self.put(('error',sys.exc_info()))
+	
+	def put(self, item):
+		while not self.stopped:
+			try:
+				self.queue.put(item,timeout = PROGRESSINTERVAL)
+				return True
+			except Queue.Full:
+				pass
+		return False
+	
+	def windows(self):
+		while True:
+			(kind,value) = self.queue.get()
+			if kind == 'end':
+				return
+			if kind == 'error':
+				raise value[0], value[1], value[2]
+			yield value
+	
+	def stop(self):
+		# when the export ends early, the reader is told to stop and the windows it read are dropped
+		self.stopped = True
+		while self.is_alive():
+			try:
+				self.queue.get(timeout = PROGRESSINTERVAL)
+			except Queue.Empty:
+				pass
+
+def definitionsOrder():
+	return DEFINITIONSORDER % {"binary": LEXICONBINARY[bool(args.dump)]}
+
+def definitionsAfter(key):
+	(lexicon,sourceid,iddef) = key
+	return DEFINITIONSAFTER % {"lexicon": conn.escape(lexicon),"binary": LEXICONBINARY[bool(args.dump)],"source": sourceid,"id": iddef}
+
+def checkpointSettings():
+	return hashlib.sha1((u"%s;%s;%s;%s;%s;%s;%s;%s;%s;%s;%s;%s" % (VERSION,','.join(edition.diacritics for edition in editions),args.group_entries,args.dedup,args.client_sort,args.minify,args.size_budget,args.frequency_list,args.max_file_size,args.max_entries_per_file,','.join(source_list),u'|'.join(source_list_names))).encode('utf-8')).hexdigest()
+
+def writeCheckpoint(key,i,letter):
+	# the key of the last definition exported and the state of the letter files, written to disk first
+	checkpoint = {
+		"settings": checkpointSettings(),
+		"key": key,
+		"definitions": i,
+		"letter": letter,
+		"counters": dict((counter,globals()[counter]) for counter in COUNTERS),
+		"editions": [edition.checkpoint() for edition in editions],
+	}
+	with open(name + '_CHECKPOINT.json.tmp','w') as f:
+		json.dump(checkpoint,f)
+	deleteFile(name + '_CHECKPOINT.json')
+	os.rename(name + '_CHECKPOINT.json.tmp',name + '_CHECKPOINT.json')
+
+def readCheckpoint():
+	# the last checkpoint of an interrupted export, if it was saved with the same options
+	filename = name + '_CHECKPOINT.json'
+	if not os.path.isfile(filename):
+		print("\nNo checkpoint found in '%s', exporting from the start..." % filename)
+		return None
+	with open(filename) as f:
+		checkpoint = json.load(f)
+	if checkpoint["settings"] != checkpointSettings():
+		print("\nThe checkpoint in '%s' was saved with other options, exporting from the start..." % filename)
+		return None
+	return checkpoint
+
+def exportWorkerInit(settings):
+	global args
+	global mysql_server
+	global mysql_port
+	global mysql_user
+	global mysql_passwd
+	global mysql_db
+	global dump_index
+	global name
+	global source_list
+	global metrics
+	
+	# only the main process asks what to do when the export is aborted
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	(args,mysql_server,mysql_port,mysql_user,mysql_passwd,mysql_db,dump_index,name,source_list) = settings
+	if args.metrics:
+		metrics = Metrics()
+	openEditions()
+	tryConnect()
+
+def exportLetter(task):
+	global metrics
+	
+	(letter,iddefs) = task
+	start_time = time.time()
+	counters = dict((counter,globals()[counter]) for counter in COUNTERS)
+	for edition in editions:
+		edition.startLetter(letter)
+	for start in range(0,len(iddefs),INFLECTION_WINDOW):
+		window = iddefs[start:start + INFLECTION_WINDOW]
+		query_time = metricsClock()
+		executeQuery(cur,"select " + DEFINITIONCOLUMNS + " from Definition d join Source s on d.sourceId = s.id where d.id in (%s)" % ','.join(str(iddef) for iddef in window))
+		rows = dict((row["id"],row) for row in cur.fetchmany(len(window)))
+		addMetric('definitions',query_time)
+		loadInflections(window)
+		for iddef in window:
+			if args.minify:
+				minifyDefinition(rows[iddef])
+			for edition in editions:
+				edition.activate()
+				printDefinition(rows[iddef])
+	for edition in editions:
+		edition.closeLetter()
+	counters = dict((counter,globals()[counter] - counters[counter]) for counter in COUNTERS)
+	lettermetrics = None
+	if metrics and args.jobs > 1:
+		lettermetrics = metrics
+		metrics = Metrics()
+	return (letter,len(iddefs),counters,time.time() - start_time,[edition.letterfiles[letter].parts for edition in editions],lettermetrics)
+
+def collectLetters(digests = None):
+	global cur
+	
+	# reads only the ids, in the final order, to split the definitions by letter;
+	# when asked for, the modification dates of each letter are added to its digest
+	columns = "d.id,d.sourceId,lexicon"
+	if digests is not None:
+		columns = columns + ",d.modDate"
+	letters = []
+	iddefs = {}
+	for rows in orderedRows(columns):
+		for row in rows:
+			letter = letterOf(row["lexicon"])
+			if letter not in iddefs:
+				letters.append(letter)
+				iddefs[letter] = []
+				if digests is not None:
+					digests[letter] = hashlib.sha1()
+			iddefs[letter].append(row["id"])
+			if digests is not None:
+				digests[letter].update("%s:%s;" % (row["id"],row["modDate"]))
+	
+	if len(letters) == 0:
+		print("Managed to retrieve 0 definitions from dictionary...\nSomething was wrong...")
+		sys.exit()
+	return (letters,iddefs)
+
+class SizeBudget(object):
+	# --size-budget: the headwords are ranked by their rank in the --frequency-list, the number of sources defining them
+	# and the number of their inflected forms, and taken in this order while the estimated size of the letter files
+	# of each edition fits the budget; a headword that does not fit with its inflected forms may still fit without them.
+	# The size of each entry is estimated while the definitions and inflections are read, before the export,
+	# as rendered (with the diacritics of each edition) but without the entries being written.
+	# The headwords left out and the ones without inflected forms are listed on the stats page, which counts too.
+	def __init__(self):
+		self.limit = int(args.size_budget * 1048576)
+		self.frequencies = {}
+		if args.frequency_list:
+			with io.open(args.frequency_list,'r',encoding = 'utf-8') as f:
+				for line in f:
+					words = line.split()
+					if words and words[0].lower() not in self.frequencies:
+						self.frequencies[words[0].lower()] = len(self.frequencies)
+		self.headwords = {}
+		self.letters = set()
+		self.starts = 0
+		self.dropped = set()
+		self.bare = set()
+		self.dropped_definitions = 0
+		self.dropped_sources = collections.Counter()
+		self.estimate = 0
+	
+	def read(self):
+		global abbreviations
 		
-		sys.stdout.write("\rExporting %s of %s..." % (i+1,cur.rowcount))
-		#if the term contains comma it will export the term again but written with cedilla
-		if isWithComma(dterm):
-			if (args.diacritics == 'cedilla') or (args.diacritics == 'both'):
-				printTerm(did,replaceWithCedilla(dterm),ddef,dsrc)
-			if (args.diacritics == 'comma') or (args.diacritics == 'both'):
-				printTerm(did,dterm,ddef,dsrc)
+		# the definitions of each source, the definitions, inflected forms and estimated size of each headword; with --group-entries
+		# the consecutive definitions of a headword are estimated as the single entry they become
+		if args.minify and abbreviations is None:
+			abbreviations = loadAbbreviations()
+		start_time = metricsClock()
+		group = []
+		letter = None
+		for rows in orderedRows(DEFINITIONCOLUMNS):
+			inflections = fetchInflections([row["id"] for row in rows])
+			for row in rows:
+				termen = row["lexicon"]
+				html = row["htmlRep"]
+				if args.minify:
+					html = minifyHtml(html)
+				if args.epub:
+					html = xhtmlHtml(html)
+				if letter != letterOf(termen):
+					# each time the letter changes a letter file is started, or reopened
+					letter = letterOf(termen)
+					self.letters.add(letter)
+					self.starts += 1
+				if termen not in self.headwords:
+					self.headwords[termen] = [collections.Counter(),0,0,[0] * len(editions),[0] * len(editions)]
+				headword = self.headwords[termen]
+				headword[0][row["source"]] += 1
+				headword[1] += 1
+				forms = inflections.get(row["id"],[])
+				headword[2] += len(forms)
+				if not args.group_entries:
+					self.addEntry(termen,forms,IDXTEMPLATEEND % (html,row["source"]))
+					continue
+				if group and group[0][0] != termen:
+					self.addGroup(group)
+					group = []
+				group.append((termen,forms,html,row["source"]))
+		if group:
+			self.addGroup(group)
+		addMetric('budget',start_time)
+	
+	def addGroup(self, group):
+		termen = group[0][0]
+		forms = mergeForms([forms for (termen,forms,html,source) in group])
+		self.addEntry(termen,forms,IDXGROUPTEMPLATEHEAD + IDXGROUPSEPARATORTEMPLATE.join(IDXGROUPVALUETEMPLATE % (html,source) for (termen,forms,html,source) in group) + IDXGROUPTEMPLATEEND)
+	
+	def addEntry(self, termen, forms, body):
+		# the size of the entries of the diacritic variants, and of their inflected forms, in each edition
+		# (with --diacritics all the entries without inflected forms still have the headword without diacritics)
+		headword = self.headwords[termen]
+		if args.epub:
+			body = xhtmlEntry(body)
+		length = len(body.encode('utf-8'))
+		for (e,edition) in enumerate(editions):
+			edition.activate()
+			variants = termVariants(termen)
+			bare = len(renderInflections(inflectionVariants([],termen)).encode('utf-8'))
+			headword[3][e] += sum(length + bare + len((IDXTEMPLATEHEAD % variant).encode('utf-8')) for variant in variants)
+			headword[4][e] += (len(renderInflections(inflectionVariants(forms,termen)).encode('utf-8')) - bare) * len(variants)
+	
+	def select(self):
+		# all the headwords start left out (and listed on the stats page); the best ranked are taken while they fit
+		start_time = metricsClock()
+		total = sum(headword[1] for headword in self.headwords.values())
+		fixed = len((generateStats(total) + STATSBUDGETTEMPLATE % (args.size_budget,len(self.headwords),total,len(self.headwords),u'',u'')).encode('utf-8'))
+		if args.epub:
+			fixed += len(xhtmlDocument(generateStats(total)).encode('utf-8')) - len(generateStats(total).encode('utf-8'))
+			fixed += self.starts * len((EPUBFRAMESETTEMPLATEHEAD + FRAMESETTEMPLATEEND).encode('utf-8'))
 		else:
-			printTerm(did,dterm,ddef,dsrc)
+			fixed += len(self.letters) * len(FRAMESETTEMPLATEHEAD.encode('utf-8')) + self.starts * len(FRAMESETTEMPLATEEND.encode('utf-8'))
+		sizes = [fixed + sum(self.listed(termen) for termen in self.headwords)] * len(editions)
+		ranked = sorted(self.headwords,key = lambda termen: (self.frequencies.get(termen.lower(),len(self.frequencies)),-len(self.headwords[termen][0]),-self.headwords[termen][2],termen))
+		for termen in ranked:
+			(sources,definitions,forms,entries,inflections) = self.headwords[termen]
+			listed = self.listed(termen)
+			if all(size + entry + inflection - listed <= self.limit for (size,entry,inflection) in zip(sizes,entries,inflections)):
+				sizes = [size + entry + inflection - listed for (size,entry,inflection) in zip(sizes,entries,inflections)]
+			elif all(size + entry <= self.limit for (size,entry) in zip(sizes,entries)):
+				# listed with the headwords without inflected forms instead
+				sizes = [size + entry for (size,entry) in zip(sizes,entries)]
+				self.bare.add(termen)
+			else:
+				self.dropped.add(termen)
+				self.dropped_definitions += definitions
+				self.dropped_sources.update(sources)
+		self.estimate = max(sizes)
+		self.headwords = None
+		addMetric('budget',start_time)
+		if metrics:
+			metrics.count('budget_dropped',len(self.dropped))
+			metrics.count('budget_without_inflections',len(self.bare))
 	
-	end_time = time.time()
-	print("\nExport time: %s" % time.strftime('%H:%M:%S',time.gmtime((end_time - start_time))))
+	def listed(self, termen):
+		return len(termen.encode('utf-8')) + 2
 	
-	if to:
-		to.write(FRAMESETTEMPLATEEND)
+	def stats(self):
+		return STATSBUDGETTEMPLATE % (args.size_budget,len(self.dropped),self.dropped_definitions,len(self.bare),u', '.join(sorted(self.dropped,key = romanianKey)),u', '.join(sorted(self.bare,key = romanianKey)))
+
+def orderedRows(columns):
+	global cur
 	
-	if to:
-			to.close()
+	# yields the rows of all the definitions, in windows, in the order of the export
+	if args.client_sort:
+		rows = sortedRows(columns)
+		while True:
+			window = list(itertools.islice(rows,INFLECTION_WINDOW))
+			if not window:
+				return
+			yield window
+	if args.stream:
+		cur = openCursor(conn,unbuffered = True)
+	start_time = metricsClock()
+	executeQuery(cur,"select " + columns + " " + DEFINITIONSFILTER % ','.join(source_list) + definitionsOrder())
+	addMetric('definitions',start_time)
+	while True:
+		start_time = metricsClock()
+		rows = cur.fetchmany(INFLECTION_WINDOW)
+		addMetric('definitions',start_time)
+		if not rows:
+			break
+		yield rows
+	if args.stream:
+		cur = openCursor(conn)
+
+def renderLetters(tasks):
+	# renders whole letter files, in worker processes (each with its own connection) when --jobs is set;
+	# the largest letters are started first so the workers finish at about the same time
+	total = sum(len(iddefs) for (letter,iddefs) in tasks)
+	tasks = sorted(tasks,key = lambda task: len(task[1]),reverse = True)
+	durations = {}
+	parts = {}
+	i = 0
+	if args.jobs > 1:
+		settings = (args,mysql_server,mysql_port,mysql_user,mysql_passwd,mysql_db,dump_index,name,source_list)
+		pool = multiprocessing.Pool(args.jobs,exportWorkerInit,(settings,))
+		results = pool.imap_unordered(exportLetter,tasks)
+	else:
+		results = (exportLetter(task) for task in tasks)
+	for (letter,count,counters,duration,letterparts,lettermetrics) in results:
+		i += count
+		if args.jobs > 1:
+			for counter in COUNTERS:
+				globals()[counter] += counters[counter]
+		if lettermetrics:
+			metrics.merge(lettermetrics)
+		durations[letter] = duration
+		parts[letter] = letterparts
+		showProgress(i,total)
+	if args.jobs > 1:
+		pool.close()
+		pool.join()
+	return (durations,parts)
 
-	generateStats(name,cur.rowcount)
+def exportLettersParallel():
+	(letters,iddefs) = collectLetters()
+	(durations,parts) = renderLetters([(letter,iddefs[letter]) for letter in letters])
+	for (e,edition) in enumerate(editions):
+		edition.parts = [part for letter in letters for part in parts[letter][e]]
+	return sum(len(iddefs[letter]) for letter in letters)
 
-	cur.close()
-	cur2.close()
+def exportLettersIncremental():
+	digests = {}
+	(letters,iddefs) = collectLetters(digests)
 	
-	to = codecs.open("%s.opf" % name, "w","utf-8")
-	to.write(OPFTEMPLATEHEAD % (name, name, time.strftime("%d/%m/%Y"),name + '_TOC',name + '_STATS'))
-	to.write(manifest)
-	to.write(OPFTEMPLATEMIDDLE)
-	to.write(spine)
-	to.write(OPFTEMPLATEEND % (name + '_TOC'))
-	to.close()
+	# the inflections that went into each letter file are part of its digest too
+	for letter in letters:
+		for start in range(0,len(iddefs[letter]),INFLECTION_WINDOW):
+			window = iddefs[letter][start:start + INFLECTION_WINDOW]
+			loadInflections(window)
+			for iddef in window:
+				digests[letter].update((u"%s:%s;" % (iddef,u'|'.join(inflection_cache[iddef]))).encode('utf-8'))
 	
-	to = codecs.open("%s_TOC.xhtml" % name, "w","utf-8")
-	to.write(TOCTEMPLATEHEAD % (name + '_STATS'))
-	to.write(toc)
-	to.write(TOCTEMPLATEEND)
-	to.close()
+	# a letter is exported again when its files changed in any of the editions;
+	# any change of the options or of the sources invalidates all the letter files of an edition
+	builds = []
+	files = []
+	changed = []
+	saved = 0
+	for edition in editions:
+		settings = hashlib.sha1((u"%s;%s;%s;%s;%s;%s;%s;%s;%s;%s;%s;%s" % (VERSION,edition.diacritics,args.group_entries,args.dedup,args.client_sort,args.minify,args.size_budget,args.frequency_list,args.max_file_size,args.max_entries_per_file,','.join(source_list),u'|'.join(source_list_names))).encode('utf-8')).hexdigest()
+		build = {"settings": settings, "files": {}}
+		if os.path.isfile(edition.name + '_BUILD.json'):
+			with open(edition.name + '_BUILD.json') as f:
+				build = json.load(f)
+			if build["settings"] != settings:
+				build["files"] = dict((letter,{"parts": build["files"][letter].get("parts",[])}) for letter in build["files"])
+		builds.append(build)
+		files.append({"settings": settings, "files": {}})
+		for letter in letters:
+			previous = build["files"].get(letter)
+			if not (previous and previous.get("digest") == digests[letter].hexdigest() and all(os.path.isfile(filename) for (itemid,filename,label) in previous["parts"])):
+				if letter not in changed:
+					changed.append(letter)
+	changed = [letter for letter in letters if letter in changed]
+	
+	# the letters without definitions any more, or split differently now, leave no stale files behind
+	for build in builds:
+		for letter in build["files"]:
+			if (letter not in iddefs) or (letter in changed):
+				for (itemid,filename,label) in build["files"][letter].get("parts",[]):
+					deleteFile(filename)
+	
+	(durations,parts) = renderLetters([(letter,iddefs[letter]) for letter in changed])
+	for (e,edition) in enumerate(editions):
+		for letter in letters:
+			if letter in changed:
+				files[e]["files"][letter] = {"digest": digests[letter].hexdigest(), "definitions": len(iddefs[letter]), "duration": durations[letter], "parts": parts[letter][e]}
+			else:
+				files[e]["files"][letter] = builds[e]["files"][letter]
+				if e == 0:
+					saved += builds[e]["files"][letter]["duration"]
+		with open(edition.name + '_BUILD.json',"w") as f:
+			json.dump(files[e],f,indent = 1,sort_keys = True)
+		edition.parts = [tuple(part) for letter in letters for part in files[e]["files"][letter]["parts"]]
+	
+	print("\nRebuilt %s of %s letters: %s" % (len(changed),len(letters),' '.join(changed).encode("utf-8")))
+	print("Time saved by reusing the unchanged letter files: %s" % time.strftime('%H:%M:%S',time.gmtime(saved)))
+	return sum(len(iddefs[letter]) for letter in letters)
 
-def runKindlegen():
+def exportDictionaryFiles(checkpoint = None):
+	global budget
+	
 	start_time = time.time()
-#	returncode = subprocess.call(['kindlegen',name + '.opf','-verbose','-dont_append_source','-c2'])
-	returncode = subprocess.call(['kindlegen',name + '.opf','-verbose','-dont_append_source'])
+	budget = None
+	if args.size_budget:
+		print("\nEstimating the size of the headwords for the budget of %s MB..." % args.size_budget)
+		plan = SizeBudget()
+		plan.read()
+		plan.select()
+		budget = plan
+	if args.incremental:
+		total = exportLettersIncremental()
+	elif args.jobs > 1:
+		total = exportLettersParallel()
+	else:
+		total = exportLetters(checkpoint)
+	if budget:
+		total -= budget.dropped_definitions
+	
 	end_time = time.time()
-	if returncode < 0:
-		print("\nKindlegen failed with return code %s.\nTemporary files will not be deleted..." % returncode)
-		return False
+	if metrics:
+		metrics.add('export',end_time - start_time)
+		metrics.count('definitions',total)
+	print("\nExport time: %s" % time.strftime('%H:%M:%S',time.gmtime((end_time - start_time))))
+	print("Queries issued: %s" % query_count)
+	print("Peak memory usage: %s" % peakMemory())
+	print("Entries exported: %s" % entry_count)
+	print("Diacritics cache hit rate: %.1f%% of %s forms" % (100.0 * diacritic_hits / max(diacritic_hits + diacritic_misses,1),diacritic_hits + diacritic_misses))
+	if args.dedup:
+		print("Duplicate definitions exported once: %s (%.1f MB saved)" % (duplicate_count,duplicate_bytes / 1048576.0))
+	if args.minify:
+		print("Definitions minified: %.1f MB to %.1f MB (%.1f%% smaller), %.3f s per MB" % (minify_input / 1048576.0,minify_output / 1048576.0,100.0 * (minify_input - minify_output) / max(minify_input,1),minify_time * 1048576.0 / max(minify_input,1)))
+	if budget:
+		print("Size budget of %s MB: %s headwords left out (%s definitions), %s without their inflected forms, %.1f MB estimated" % (args.size_budget,len(budget.dropped),budget.dropped_definitions,len(budget.bare),budget.estimate / 1048576.0))
+		if budget.estimate > budget.limit:
+			print("The list of the headwords left out, on the stats page, does not fit in the size budget")
+
+	for edition in editions:
+		start_time = metricsClock()
+		if args.epub:
+			writePackage(edition.name,edition.parts,total,edition.container)
+			edition.container.close()
+			print("EPUB of '%s': %.1f MB" % (edition.name,os.path.getsize(edition.name + '.epub') / 1048576.0))
+		else:
+			print("Letter files of '%s': %.1f MB" % (edition.name,sum(os.path.getsize(filename) for (itemid,filename,label) in edition.parts) / 1048576.0))
+			writePackage(edition.name,edition.parts,total)
+		addMetric('package',start_time)
+		for writer in edition.writers:
+			start_time = metricsClock()
+			writer.close()
+			addMetric('formats',start_time)
+			print(writer.summary())
+		del edition.writers[:]
+		if edition.lookup:
+			start_time = metricsClock()
+			edition.lookup.close()
+			addMetric('lookup',start_time)
+			print("Lookup index of '%s': %.1f MB, %s words of %s entries" % (edition.name,os.path.getsize(edition.lookup.filename) / 1048576.0,edition.lookup.words,edition.lookup.count))
+			edition.lookup = None
+	return total
+
+def writePackage(filemask,parts,total,container = None):
+	# the OPF, the TOC and the stats, as files next to the letter files, or as the EPUB 3 package document,
+	# navigation document and XHTML stats in the --epub container
+	if container:
+		filemask = os.path.basename(filemask)
+	manifest = ''
+	spine = ''
+	toc = ''
+	for (itemid,filename,label) in parts:
+		manifest = manifest + '\t\t<item id="' + itemid + '" href="' + filename + '" media-type="' + ('application/xhtml+xml' if container else 'text/x-oeb1-document') + '"/>\n'
+		spine = spine + '\t\t<itemref idref="' + itemid + '"/>\n'
+		toc = toc + '\n\t\t\t\t\t\t<li><a href="' + filename + '">' + label + '</a></li>'
+
+	if container:
+		files = [
+			(filemask + "_STATS.html",xhtmlDocument(generateStats(total))),
+			(filemask + ".opf",EPUBOPFTEMPLATEHEAD % (filemask, filemask, time.strftime("%Y-%m-%d"),time.strftime("%Y-%m-%dT%H:%M:%SZ",time.gmtime()),filemask + '_TOC',filemask + '_STATS') + manifest + EPUBOPFTEMPLATEMIDDLE + spine + EPUBOPFTEMPLATEEND),
+			(filemask + "_TOC.xhtml",EPUBNAVTEMPLATEHEAD % (filemask + '_STATS') + toc.replace('\n\t\t\t\t\t\t','\n\t\t\t\t') + EPUBNAVTEMPLATEEND),
+		]
 	else:
-		print("\nKindlegen finished in %s" % time.strftime('%H:%M:%S',time.gmtime((end_time - start_time))))
+		files = [
+			(filemask + "_STATS.html",generateStats(total)),
+			(filemask + ".opf",OPFTEMPLATEHEAD % (filemask, filemask, time.strftime("%d/%m/%Y"),filemask + '_TOC',filemask + '_STATS') + manifest + OPFTEMPLATEMIDDLE + spine + OPFTEMPLATEEND % (filemask + '_TOC')),
+			(filemask + "_TOC.xhtml",TOCTEMPLATEHEAD % (filemask + '_STATS') + toc + TOCTEMPLATEEND),
+		]
+	for (filename,text) in files:
+		if container:
+			container.writestr(filename,text)
+		else:
+			to = codecs.open(filename,"w","utf-8")
+			to.write(text)
+			to.close()
+
+def temporaryIndex(filename):
+	# a temporary sqlite database next to the output file, where an index is sorted on disk
+	fd, indexname = tempfile.mkstemp(prefix=os.path.basename(filename) + '_index_',suffix='.sqlite',dir=os.path.dirname(os.path.abspath(filename)))
+	os.close(fd)
+	atexit.register(deleteFile,indexname)
+	db = sqlite3.connect(indexname)
+	db.execute("pragma synchronous = off")
+	db.execute("pragma journal_mode = off")
+	return (db,indexname)
+
+def htmlText(html):
+	# the text of a definition, for the formats without HTML
+	text = HTMLENTITIES.unescape(HTMLTAG.sub(u'',HTMLBREAK.sub(u'\n',html)))
+	return u'\n'.join(line.strip() for line in text.split(u'\n') if line.strip())
+
+class DictzipFile(object):
+	# a dictzip file (.dict.dz of StarDict and dictd): gzip compressed in chunks that can be read on their own,
+	# listed in the header; the chunks are kept in a temporary file until their number is known
+	def __init__(self, filename):
+		self.filename = filename
+		self.chunks = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(filename)))
+		self.sizes = []
+		self.pending = ''
+		self.length = 0
+		self.crc = 0
+		self.compressor = zlib.compressobj(9,zlib.DEFLATED,-zlib.MAX_WBITS)
+	
+	def write(self, data):
+		# returns the offset of the data in the uncompressed file
+		offset = self.length
+		self.length += len(data)
+		self.crc = zlib.crc32(data,self.crc)
+		self.pending += data
+		if len(self.pending) >= DICTZIPCHUNK:
+			start = 0
+			while len(self.pending) - start >= DICTZIPCHUNK:
+				self.writeChunk(self.pending[start:start + DICTZIPCHUNK],zlib.Z_FULL_FLUSH)
+				start += DICTZIPCHUNK
+			self.pending = self.pending[start:]
+		return offset
+	
+	def writeChunk(self, data, flush):
+		chunk = self.compressor.compress(data) + self.compressor.flush(flush)
+		self.chunks.write(chunk)
+		self.sizes.append(len(chunk))
+	
+	def close(self):
+		self.writeChunk(self.pending,zlib.Z_FINISH)
+		if 10 + 2 * len(self.sizes) > 0xffff:
+			raise ValueError("'%s' needs %s chunks, more than a dictzip file can list" % (self.filename,len(self.sizes)))
+		extra = 'RA' + struct.pack('<HHHH',6 + 2 * len(self.sizes),1,DICTZIPCHUNK,len(self.sizes)) + struct.pack('<%dH' % len(self.sizes),*self.sizes)
+		f = open(self.filename,'wb')
+		f.write('\x1f\x8b\x08\x04' + struct.pack('<L',int(time.time())) + '\x02\x03' + struct.pack('<H',len(extra)) + extra)
+		self.chunks.seek(0)
+		shutil.copyfileobj(self.chunks,f)
+		f.write(struct.pack('<LL',self.crc & 0xffffffff,self.length & 0xffffffff))
+		f.close()
+		self.chunks.close()
+
+class StarDictWriter(object):
+	# a StarDict dictionary (--formats stardict): the articles are compressed in '<outputfile>.dict.dz' as they are exported,
+	# while their offsets and the synonyms (.syn) go to a temporary sqlite database; at the end the .idx and the .syn are
+	# read from it in the order of StarDict (ASCII letters without case, then bytes), with no second pass over the articles
+	def __init__(self, filemask):
+		self.filemask = filemask
+		self.dict = DictzipFile(filemask + '.dict.dz')
+		(self.db,self.indexname) = temporaryIndex(filemask + '.idx')
+		self.db.execute("create table Articles (id integer primary key, key text, word text, offset integer, size integer)")
+		self.db.execute("create table Synonyms (key text, word text, article integer)")
+		self.articles = []
+		self.synonyms = []
+		self.count = 0
+		self.words = 0
+		self.synwords = 0
+	
+	def addArticle(self, headword, synonyms, html):
+		if len(headword.encode('utf-8')) > STARDICTWORD:
+			return
+		data = html.encode('utf-8')
+		offset = self.dict.write(data)
+		self.count += 1
+		self.articles.append((self.count,headword.translate(STARDICTASCIILOWER),headword,offset,len(data)))
+		for word in synonyms:
+			if len(word.encode('utf-8')) <= STARDICTWORD:
+				self.synonyms.append((word.translate(STARDICTASCIILOWER),word,self.count))
+		if len(self.articles) + len(self.synonyms) >= INFLECTION_WINDOW:
+			self.flush()
+	
+	def flush(self):
+		self.db.executemany("insert into Articles values (?,?,?,?,?)",self.articles)
+		self.db.executemany("insert into Synonyms values (?,?,?)",self.synonyms)
+		self.articles = []
+		self.synonyms = []
+	
+	def close(self):
+		self.flush()
+		self.dict.close()
+		# the position of each article in the .idx, to which its synonyms point
+		self.db.execute("create table Positions (position integer primary key, article integer)")
+		self.db.execute("insert into Positions (article) select id from Articles order by key, word")
+		self.db.execute("create index Positions_article on Positions (article)")
+		
+		f = open(self.filemask + '.idx','wb')
+		for (word,offset,size) in self.db.execute("select a.word, a.offset, a.size from Positions p join Articles a on a.id = p.article order by p.position"):
+			f.write(word.encode('utf-8') + '\0' + struct.pack('>LL',offset,size))
+			self.words += 1
+		idxsize = f.tell()
+		f.close()
+		f = open(self.filemask + '.syn','wb')
+		for (word,position) in self.db.execute("select s.word, p.position from Synonyms s join Positions p on p.article = s.article order by s.key, s.word, p.position"):
+			f.write(word.encode('utf-8') + '\0' + struct.pack('>L',position - 1))
+			self.synwords += 1
+		f.close()
+		self.db.close()
+		deleteFile(self.indexname)
+		
+		ifo = [
+			"StarDict's dict ifo file",
+			"version=3.0.0",
+			"bookname=%s" % os.path.basename(self.filemask),
+			"wordcount=%d" % self.words,
+			"synwordcount=%d" % self.synwords,
+			"idxfilesize=%d" % idxsize,
+			"author=dex2xml %s" % VERSION,
+			"website=http://dexonline.ro",
+			"description=%s" % ', '.join(source_list_names).replace('\n',' '),
+			"date=%s" % time.strftime('%Y.%m.%d'),
+			"sametypesequence=h",
+		]
+		f = codecs.open(self.filemask + '.ifo','w','utf-8')
+		f.write(u'\n'.join(ifo) + u'\n')
+		f.close()
+	
+	def summary(self):
+		return "StarDict of '%s': %.1f MB, %s words and %s synonyms" % (self.filemask,os.path.getsize(self.filemask + '.dict.dz') / 1048576.0,self.words,self.synwords)
+
+def dictdKey(word):
+	# dictd compares the words without case, only by their letters, digits and spaces
+	return u''.join(c for c in word.lower() if c.isalnum() or c.isspace())
+
+def dictdNumber(value):
+	digits = DICTDDIGITS[value & 63]
+	value >>= 6
+	while value:
+		digits = DICTDDIGITS[value & 63] + digits
+		value >>= 6
+	return digits
+
+class DictdWriter(object):
+	# a dictd database (--formats dictd): the articles, as text, are compressed in '<outputfile>_dictd.dict.dz'
+	# as they are exported and the index lines of the headwords and of their synonyms are sorted by sqlite on disk
+	def __init__(self, filemask):
+		self.filemask = filemask + '_dictd'
+		self.dict = DictzipFile(self.filemask + '.dict.dz')
+		(self.db,self.indexname) = temporaryIndex(self.filemask + '.index')
+		self.db.execute("create table Words (key text, word text, offset integer, size integer)")
+		self.words = []
+		self.count = 0
+		# the entries describing the database
+		self.addArticle(u'00-database-utf8',[],u'')
+		self.addArticle(u'00-database-short',[],os.path.basename(filemask))
+		self.addArticle(u'00-database-url',[],u'http://dexonline.ro')
+		self.addArticle(u'00-database-info',[],u'%s, exported by dex2xml %s on %s' % (u', '.join(source_list_names),VERSION,time.strftime('%d/%m/%Y')))
+	
+	def addArticle(self, headword, synonyms, html):
+		text = headword + u'\n' + u''.join(DICTDINDENT + line + u'\n' for line in htmlText(html).split(u'\n') if line) + u'\n'
+		data = text.encode('utf-8')
+		offset = self.dict.write(data)
+		for word in [headword] + synonyms:
+			self.words.append((dictdKey(word),word,offset,len(data)))
+		if len(self.words) >= INFLECTION_WINDOW:
+			self.flush()
+	
+	def flush(self):
+		self.db.executemany("insert into Words values (?,?,?,?)",self.words)
+		self.words = []
+	
+	def close(self):
+		self.flush()
+		self.dict.close()
+		f = open(self.filemask + '.index','wb')
+		for (word,offset,size) in self.db.execute("select word, offset, size from Words order by key, word, offset"):
+			f.write(word.encode('utf-8') + '\t' + dictdNumber(offset) + '\t' + dictdNumber(size) + '\n')
+			self.count += 1
+		f.close()
+		self.db.close()
+		deleteFile(self.indexname)
+	
+	def summary(self):
+		return "dictd database of '%s': %.1f MB, %s words in the index" % (self.filemask,os.path.getsize(self.filemask + '.dict.dz') / 1048576.0,self.count)
+
+FORMATWRITERS = {'stardict': StarDictWriter,'dictd': DictdWriter}
+
+class LookupWriter(object):
+	# the lookup index of --lookup-index: every idx:orth and idx:iform value of the entries, with the letter file
+	# and the offset of the entries it finds; the words are sorted by sqlite on disk as in the other writers, and
+	# written with a table of their offsets, so LookupIndex can search them by bisection in the memory-mapped file
+	def __init__(self, filename):
+		self.filename = filename
+		(self.db,self.indexname) = temporaryIndex(filename)
+		self.db.execute("create table Entries (id integer primary key, file integer, offset integer, length integer)")
+		self.db.execute("create table Words (word text, entry integer, iform integer)")
+		self.files = {}
+		self.entries = []
+		self.rows = []
+		self.count = 0
+		self.words = 0
+	
+	def addEntry(self, termen, inflections, filename, offset, length):
+		start_time = metricsClock()
+		if filename not in self.files:
+			self.files[filename] = len(self.files)
+		self.entries.append((self.count,self.files[filename],offset,length))
+		self.rows.append((termen,self.count,0))
+		self.rows.extend((form,self.count,1) for form in set(inflections) if form != termen)
+		self.count += 1
+		if len(self.rows) >= INFLECTION_WINDOW:
+			self.flush()
+		addMetric('lookup',start_time)
+	
+	def flush(self):
+		self.db.executemany("insert into Entries values (?,?,?,?)",self.entries)
+		self.db.executemany("insert into Words values (?,?,?)",self.rows)
+		self.entries = []
+		self.rows = []
+	
+	def close(self):
+		self.flush()
+		directory = os.path.dirname(os.path.abspath(self.filename))
+		# the records of the words, each followed by the entries it finds, and the word of each headword
+		records = tempfile.TemporaryFile(dir=directory)
+		offsets = array.array('L')
+		headwords = array.array('L',[0]) * self.count
+		postings = []
+		previous = None
+		for (word,entry,iform) in self.db.execute("select word, entry, iform from Words order by word, entry, iform"):
+			if word != previous:
+				self.writeRecord(records,offsets,previous,postings)
+				previous = word
+				postings = []
+			if not iform:
+				headwords[entry] = len(offsets)
+			postings.append(entry << 1 | iform)
+		self.writeRecord(records,offsets,previous,postings)
+		self.words = len(offsets)
+		
+		files = [filename.encode('utf-8') if isinstance(filename,unicode) else filename for filename in sorted(self.files,key = self.files.get)]
+		files = ''.join(struct.pack('>H',len(filename)) + filename for filename in files)
+		entriesoffset = struct.calcsize(LOOKUPHEADER) + len(files)
+		keysoffset = entriesoffset + struct.calcsize(LOOKUPENTRY) * self.count
+		recordsoffset = keysoffset + 4 * len(offsets)
+		f = open(self.filename,'wb')
+		f.write(struct.pack(LOOKUPHEADER,LOOKUPMAGIC,len(self.files),self.count,len(offsets),struct.calcsize(LOOKUPHEADER),entriesoffset,keysoffset))
+		f.write(files)
+		for (entry,fileindex,offset,length) in self.db.execute("select id, file, offset, length from Entries order by id"):
+			f.write(struct.pack(LOOKUPENTRY,fileindex,offset,length,headwords[entry]))
+		for offset in offsets:
+			f.write(struct.pack('>L',recordsoffset + offset))
+		records.seek(0)
+		shutil.copyfileobj(records,f)
+		f.close()
+		records.close()
+		self.db.close()
+		deleteFile(self.indexname)
+	
+	def writeRecord(self, f, offsets, word, postings):
+		if word is None:
+			return
+		word = word.encode('utf-8')
+		offsets.append(f.tell())
+		f.write(struct.pack('>HL',len(word),len(postings)) + word + struct.pack('>%dL' % len(postings),*postings))
+
+class LookupIndex(object):
+	# reads a lookup index written by --lookup-index; the file is memory-mapped, so opening it reads only the header
+	# and the names of the letter files, and a search reads the few words of its bisection
+	def __init__(self, filename):
+		self.file = open(filename,'rb')
+		self.map = mmap.mmap(self.file.fileno(),0,access = mmap.ACCESS_READ)
+		(magic,files,self.entries,self.keys,filesoffset,self.entriesoffset,self.keysoffset) = struct.unpack_from(LOOKUPHEADER,self.map,0)
+		if magic != LOOKUPMAGIC:
+			raise ValueError("'%s' is not a lookup index of dex2xml" % filename)
+		self.files = []
+		offset = filesoffset
+		for i in range(files):
+			(length,) = struct.unpack_from('>H',self.map,offset)
+			self.files.append(self.map[offset + 2:offset + 2 + length].decode('utf-8'))
+			offset += 2 + length
+	
+	def word(self, i):
+		(record,) = struct.unpack_from('>L',self.map,self.keysoffset + 4 * i)
+		(length,count) = struct.unpack_from('>HL',self.map,record)
+		return (self.map[record + 6:record + 6 + length],record + 6 + length,count)
+	
+	def bisect(self, word):
+		# the first word not smaller than the given one (utf-8 encoded)
+		(low,high) = (0,self.keys)
+		while low < high:
+			middle = (low + high) // 2
+			if self.word(middle)[0] < word:
+				low = middle + 1
+			else:
+				high = middle
+		return low
+	
+	def found(self, postings, count):
+		# the entries of a word: (headword, 'orth' or 'iform', letter file, offset, length)
+		entries = []
+		for posting in struct.unpack_from('>%dL' % count,self.map,postings):
+			(fileindex,offset,length,headword) = struct.unpack_from(LOOKUPENTRY,self.map,self.entriesoffset + struct.calcsize(LOOKUPENTRY) * (posting >> 1))
+			entries.append((self.word(headword)[0].decode('utf-8'),'iform' if posting & 1 else 'orth',self.files[fileindex],offset,length))
+		return entries
+	
+	def lookup(self, word):
+		word = word.encode('utf-8')
+		i = self.bisect(word)
+		if i < self.keys:
+			(found,postings,count) = self.word(i)
+			if found == word:
+				return self.found(postings,count)
+		return []
+	
+	def prefix(self, prefix, limit = None):
+		# the words starting with the prefix, in order, with their entries
+		prefix = prefix.encode('utf-8')
+		words = []
+		i = self.bisect(prefix)
+		while i < self.keys and (limit is None or len(words) < limit):
+			(word,postings,count) = self.word(i)
+			if not word.startswith(prefix):
+				break
+			words.append((word.decode('utf-8'),self.found(postings,count)))
+			i += 1
+		return words
+	
+	def close(self):
+		self.map.close()
+		self.file.close()
+
+class KindlegenJob(object):
+	# a kindlegen conversion of an OPF, with its output captured in <filemask>_kindlegen.log
+	def __init__(self, filemask):
+		self.filemask = filemask
+		self.source = filemask + ('.epub' if args.epub else '.opf')
+		self.logname = filemask + '_kindlegen.log'
+		self.process = None
+		self.returncode = None
+		self.timedout = False
+		self.start_time = 0
+		self.duration = 0
+	
+	def start(self):
+		self.log = open(self.logname,'w')
+		self.start_time = time.time()
+#		self.process = subprocess.Popen([args.kindlegen_path,self.source,'-verbose','-dont_append_source','-c2'],stdout=self.log,stderr=subprocess.STDOUT)
+		self.process = subprocess.Popen([args.kindlegen_path,self.source,'-verbose','-dont_append_source'],stdout=self.log,stderr=subprocess.STDOUT)
+	
+	def poll(self):
+		# returns True when the conversion is over, stopping it if it took too long
+		if self.process.poll() is None:
+			if not (args.kindlegen_timeout and time.time() - self.start_time > args.kindlegen_timeout):
+				return False
+			self.timedout = True
+			self.process.kill()
+			self.process.wait()
+		self.returncode = self.process.returncode
+		self.duration = time.time() - self.start_time
+		self.log.close()
 		return True
+	
+	def succeeded(self):
+		# kindlegen exits with 1 when the MOBI was built with warnings and with 2 when it was not built
+		return (not self.timedout) and (self.returncode in (0,1))
+
+def runKindlegen(filemasks):
+	# runs at most --kindlegen-jobs conversions at the same time and
+	# returns the file masks of the ones that succeeded
+	jobs = [KindlegenJob(filemask) for filemask in filemasks]
+	pending = list(jobs)
+	running = []
+	while pending or running:
+		while pending and len(running) < args.kindlegen_jobs:
+			job = pending.pop(0)
+			print("\nRunning kindlegen for '%s' (log: %s)..." % (job.source,job.logname))
+			job.start()
+			running.append(job)
+		time.sleep(KINDLEGENPOLL)
+		for job in running[:]:
+			if job.poll():
+				running.remove(job)
+	
+	print("\n%-40s %10s %10s" % ("Kindlegen job","Duration","Exit code"))
+	for job in jobs:
+		print("%-40s %10s %10s" % (job.source,time.strftime('%H:%M:%S',time.gmtime(job.duration)),'timeout' if job.timedout else job.returncode))
+	if metrics:
+		for job in jobs:
+			metrics.add('kindlegen',job.duration)
+			metrics.kindlegen.append({"source": job.source,"seconds": round(job.duration,3),"exit_code": 'timeout' if job.timedout else job.returncode})
+	for job in jobs:
+		if not job.succeeded():
+			print("\nKindlegen failed for '%s' (see %s).\nTemporary files will not be deleted..." % (job.source,job.logname))
+	return [job.filemask for job in jobs if job.succeeded()]
+
+def palmdocCompress(data):
+	# the LZ77 compression of PalmDOC: back references of 3 to 10 bytes within the last 2047,
+	# a space and a character merged in one byte, and runs of up to 8 bytes above 0x7f
+	out = []
+	i = 0
+	n = len(data)
+	while i < n:
+		length = 0
+		if i >= 3 and n - i >= 3:
+			window = max(0,i - 2047)
+			match = data.rfind(data[i:i + 3],window,i)
+			if match >= 0:
+				# the markup repeats a lot, so the longest match is looked for first
+				longest = data.rfind(data[i:i + 10],window,i) if n - i >= 10 else -1
+				if longest >= 0:
+					(match,length) = (longest,10)
+				else:
+					length = 3
+					while length < 9 and i + length < n:
+						longer = data.rfind(data[i:i + length + 1],window,i)
+						if longer < 0:
+							break
+						match = longer
+						length += 1
+		if length:
+			distance = (i - match) << 3 | (length - 3)
+			out.append(chr(0x80 | distance >> 8) + chr(distance & 0xff))
+			i += length
+			continue
+		c = data[i]
+		if c == ' ' and i + 1 < n and '\x40' <= data[i + 1] <= '\x7f':
+			out.append(chr(ord(data[i + 1]) ^ 0x80))
+			i += 2
+		elif c == '\0' or '\x09' <= c <= '\x7f':
+			out.append(c)
+			i += 1
+		else:
+			j = i + 1
+			while j < n and j - i < 8 and (data[j] >= '\x80' or '\x01' <= data[j] <= '\x08'):
+				j += 1
+			out.append(chr(j - i) + data[i:j])
+			i = j
+	return ''.join(out)
+
+def mobiNumber(value):
+	# the variable width integers of the index entries: 7 bits a byte, the last byte marked by the high bit
+	data = chr(0x80 | (value & 0x7f))
+	value >>= 7
+	while value:
+		data = chr(value & 0x7f) + data
+		value >>= 7
+	return data
+
+class MobiWriter(object):
+	# the built-in replacement of kindlegen (--mobi-writer builtin): writes a MOBI dictionary with the
+	# text in PalmDOC compressed records and an orth index of the headwords and their inflected forms;
+	# the records are kept in a temporary file and the index is sorted by sqlite on disk, so the memory used
+	# does not grow with the size of the dictionary
+	def __init__(self, filename, title):
+		self.filename = filename
+		self.title = title
+		self.directory = os.path.dirname(os.path.abspath(filename))
+		self.text = tempfile.TemporaryFile(dir=self.directory)
+		self.records = []
+		self.pending = MOBITEXTHEAD
+		self.length = 0
+		self.entries = 0
+		self.cover = None
+		self.characters = set()
+		self.labels = []
+		(self.db,self.indexname) = temporaryIndex(filename)
+		self.db.execute("create table MobiIndex (label text, start integer, length integer)")
+	
+	def write(self, text):
+		self.pending += text
+		# a record ends only when the bytes completing its last character are known
+		while len(self.pending) > MOBIRECORDSIZE + 3:
+			self.writeRecord()
+	
+	def writeRecord(self):
+		record = self.pending[:MOBIRECORDSIZE]
+		self.pending = self.pending[MOBIRECORDSIZE:]
+		self.length += len(record)
+		# a character split between two records is completed at the end of the first one
+		overlap = ''
+		while len(overlap) < 3 and len(overlap) < len(self.pending) and '\x80' <= self.pending[len(overlap)] < '\xc0':
+			overlap += self.pending[len(overlap)]
+		data = palmdocCompress(record) + overlap + chr(len(overlap))
+		self.text.write(data)
+		self.records.append(len(data))
+	
+	def addPage(self, html):
+		# the body of a page before the entries (the stats and the abbreviations)
+		body = MOBIBODY.search(html)
+		if body:
+			self.write(MOBISPACE.sub('',body.group(1)) + MOBIPAGEBREAK)
+	
+	def addEntry(self, entry):
+		# the content of an <idx:entry>: the text without the idx tags, found by the headword and the inflected forms
+		orth = MOBIORTH.search(entry)
+		if not orth:
+			return
+		termen = orth.group(1).split('<idx:infl>')[0].strip()
+		text = MOBISPACE.sub('',entry[:orth.start()] + termen + entry[orth.end():])
+		start = self.length + len(self.pending)
+		self.write(text + MOBIPAGEBREAK)
+		self.entries += 1
+		for label in set([termen] + MOBIIFORM.findall(orth.group(1))):
+			label = label.decode('utf-8')
+			if 0 < len(label) <= MOBILABEL and max(label) <= u'\uffff':
+				self.characters.update(label)
+				self.labels.append((label,start,len(text)))
+		if len(self.labels) >= INFLECTION_WINDOW:
+			self.flushLabels()
+	
+	def flushLabels(self):
+		self.db.executemany("insert into MobiIndex values (?,?,?)",self.labels)
+		self.labels = []
+	
+	def writeIndex(self, f):
+		# the orth index records, sorted in the code point order of the labels; the ORDT table maps their
+		# characters to 8 bit (or, when there are too many, 16 bit) units in the same order
+		characters = sorted(self.characters)
+		if len(characters) < 255:
+			(self.ordtype,encoding) = (1,'latin-1')
+		else:
+			(self.ordtype,encoding) = (0,'utf-16-be')
+		units = dict((ord(c),i + 1) for (i,c) in enumerate(characters))
+		self.ordt = [0] + [ord(c) for c in characters]
+		
+		self.flushLabels()
+		self.db.commit()
+		records = []
+		entries = []
+		size = 0
+		last = ''
+		total = 0
+		for (label,start,length) in self.db.execute("select distinct label,start,length from MobiIndex order by label,start"):
+			label = label.translate(units).encode(encoding)
+			if len(label) > 255:
+				continue
+			entry = chr(len(label)) + label + '\x03' + mobiNumber(start) + mobiNumber(length)
+			if size + len(entry) + 2 * (len(entries) + 1) > MOBIINDEXSIZE:
+				records.append(self.writeIndexRecord(f,entries,last))
+				entries = []
+				size = 0
+			entries.append(entry)
+			size += len(entry)
+			last = label
+			total += 1
+		if entries:
+			records.append(self.writeIndexRecord(f,entries,last))
+		self.db.close()
+		deleteFile(self.indexname)
+		return (records,total)
+	
+	def writeIndexRecord(self, f, entries, last):
+		offsets = []
+		body = ''
+		for entry in entries:
+			offsets.append(MOBIINDEXHEADER + len(body))
+			body += entry
+		body += '\0' * (-len(body) % 4)
+		idxt = 'IDXT' + ''.join(struct.pack('>H',offset) for offset in offsets)
+		idxt += '\0' * (-len(idxt) % 4)
+		header = 'INDX' + struct.pack('>8L',MOBIINDEXHEADER,0,1,0,MOBIINDEXHEADER + len(body),len(entries),0xffffffff,0xffffffff)
+		record = header + '\0' * (MOBIINDEXHEADER - len(header)) + body + idxt
+		f.write(record)
+		return (len(record),last,len(entries))
+	
+	def indexHeader(self, records, total):
+		# the first record of the index: the tags of the entries, the last label of each record and the ORDT table
+		tagx = 'TAGX' + struct.pack('>LL',24,1) + '\x01\x01\x01\x00' + '\x02\x01\x02\x00' + '\x00\x00\x00\x01'
+		offsets = []
+		geometry = ''
+		for (size,last,count) in records:
+			offsets.append(MOBIINDEXHEADER + len(tagx) + len(geometry))
+			geometry += chr(len(last)) + last + struct.pack('>H',count)
+		geometry += '\0' * (-len(geometry) % 4)
+		idxt = 'IDXT' + ''.join(struct.pack('>H',offset) for offset in offsets)
+		idxt += '\0' * (-len(idxt) % 4)
+		ordt1 = 'ORDT' + ''.join(chr(i & 0xff) for i in range(len(self.ordt)))
+		ordt1 += '\0' * (-len(ordt1) % 4)
+		ordt2 = 'ORDT' + struct.pack('>%dH' % len(self.ordt),*self.ordt)
+		ordt2 += '\0' * (-len(ordt2) % 4)
+		idxtoffset = MOBIINDEXHEADER + len(tagx) + len(geometry)
+		ordtoffset = idxtoffset + len(idxt)
+		header = 'INDX' + struct.pack('>13L',MOBIINDEXHEADER,0,0,0,idxtoffset,len(records),65001,MOBILANGUAGE,total,0,0,0,0)
+		header += '\0' * (0xa4 - len(header)) + struct.pack('>5L',self.ordtype,len(self.ordt),ordtoffset,ordtoffset + len(ordt1),MOBIINDEXHEADER)
+		record = header + '\0' * (MOBIINDEXHEADER - len(header)) + tagx + geometry + idxt + ordt1 + ordt2
+		if len(record) > 0x10000:
+			raise ValueError("the index has too many records")
+		return record
+	
+	def header(self, textrecords, orthindex, firstimage, lastcontent, flis):
+		# record 0: the PalmDOC header, the MOBI header, the EXTH metadata and the title
+		title = self.title.encode('utf-8')
+		exth = [(100,'dex2xml'),(503,title),(524,'ro'),(531,'ro'),(532,'ro'),(501,'EBOK')]
+		if firstimage != 0xffffffff:
+			exth.append((201,struct.pack('>L',0)))
+		exth = 'EXTH' + struct.pack('>LL',12 + sum(len(value) + 8 for (key,value) in exth),len(exth)) + ''.join(struct.pack('>LL',key,len(value) + 8) + value for (key,value) in exth)
+		exth += '\0' * (4 - len(exth) % 4)
+		
+		palmdoc = struct.pack('>HHLHHHH',2,0,self.length,textrecords,MOBIRECORDSIZE,0,0)
+		mobi = 'MOBI' + struct.pack('>LLLLL',232,2,65001,zlib.crc32(title) & 0xffffffff,6)
+		mobi += struct.pack('>LL',orthindex,0xffffffff) + '\xff' * 32
+		mobi += struct.pack('>LLLLLLLL',textrecords + 1,16 + 232 + len(exth),len(title),MOBILANGUAGE,MOBILANGUAGE,MOBILANGUAGE,6,firstimage)
+		mobi += '\0' * 16 + struct.pack('>L',0x50) + '\0' * 32
+		mobi += struct.pack('>LLLLL',0xffffffff,0xffffffff,0,0,0) + '\0' * 8
+		mobi += struct.pack('>HHLLLLL',1,lastcontent,1,flis + 1,1,flis,1) + '\0' * 8
+		mobi += struct.pack('>LLLLLL',0xffffffff,0,0xffffffff,0xffffffff,1,0xffffffff)
+		return palmdoc + mobi + exth + title + '\0' * (2 + (-len(title) - 2) % 4)
+	
+	def close(self):
+		self.write(MOBITEXTEND)
+		while self.pending:
+			self.writeRecord()
+		
+		index = tempfile.TemporaryFile(dir=self.directory)
+		(indexrecords,total) = self.writeIndex(index)
+		indexheader = self.indexHeader(indexrecords,total)
+		
+		# the records: the header, the text, the index, the cover, FLIS, FCIS and EOF
+		orthindex = len(self.records) + 1
+		sizes = [0] + self.records + [len(indexheader)] + [size for (size,last,count) in indexrecords]
+		firstimage = 0xffffffff
+		if self.cover:
+			firstimage = len(sizes)
+			sizes.append(len(self.cover))
+		lastcontent = len(sizes) - 1
+		flis = len(sizes)
+		sizes.extend([len(MOBIFLIS),len(MOBIFCIS % struct.pack('>L',self.length)),len(MOBIEOF)])
+		if len(sizes) > 0xffff:
+			raise ValueError("the dictionary needs %s records, more than the 65535 of a MOBI file" % len(sizes))
+		header = self.header(len(self.records),orthindex,firstimage,lastcontent,flis)
+		sizes[0] = len(header)
+		
+		f = open(self.filename,'wb')
+		name = re.sub('[^A-Za-z0-9]','_',self.title.encode('ascii','replace'))[:31]
+		now = int(time.time())
+		f.write(struct.pack('>32sHHLLLLLL4s4sLLH',name,0,0,now,now,0,0,0,0,'BOOK','MOBI',2 * len(sizes) - 1,0,len(sizes)))
+		offset = 78 + 8 * len(sizes) + 2
+		for (i,size) in enumerate(sizes):
+			f.write(struct.pack('>LL',offset,2 * i))
+			offset += size
+		f.write('\0\0')
+		f.write(header)
+		self.text.seek(0)
+		shutil.copyfileobj(self.text,f)
+		f.write(indexheader)
+		index.seek(0)
+		shutil.copyfileobj(index,f)
+		if self.cover:
+			f.write(self.cover)
+		f.write(MOBIFLIS + MOBIFCIS % struct.pack('>L',self.length) + MOBIEOF)
+		f.close()
+		self.text.close()
+		index.close()
+		return total
+
+def letterEntries(f):
+	# yields the content of the <idx:entry> elements of a letter file, reading it in chunks
+	data = ''
+	while True:
+		chunk = f.read(LETTERBUFFER)
+		data += chunk
+		end = data.rfind('</idx:entry>')
+		if end >= 0:
+			end += len('</idx:entry>')
+			for entry in MOBIENTRY.finditer(data,0,end):
+				yield entry.group(1)
+			data = data[end:]
+		if not chunk:
+			break
+	f.close()
+
+def writeMobi(edition):
+	# converts an edition with the built-in writer, from its letter files, stats, abbreviations and cover
+	# (read from the --epub container, when there is one); returns the number of words in the index
+	if args.epub:
+		container = zipfile.ZipFile(edition.name + '.epub')
+		members = set(container.namelist())
+		openFile = lambda filename: container.open(os.path.basename(filename)) if os.path.basename(filename) in members else None
+		openResource = openFile
+	else:
+		openFile = lambda filename: io.open(filename,'rb') if os.path.isfile(filename) else None
+		openResource = lambda filename: openFile(findResource(filename,edition.name) or filename)
+	
+	writer = MobiWriter(edition.name + '.mobi',os.path.basename(edition.name))
+	for f in [openFile(edition.name + '_STATS.html'),openResource('Abrevieri.html')]:
+		if f:
+			writer.addPage(f.read())
+			f.close()
+	for (itemid,filename,label) in edition.parts:
+		for entry in letterEntries(openFile(filename)):
+			writer.addEntry(entry)
+	f = openResource('cover.jpg')
+	if f:
+		writer.cover = f.read()
+		f.close()
+	total = writer.close()
+	if args.epub:
+		container.close()
+	return (writer.entries,total)
+
+def runMobiWriter(editions):
+	# the built-in writer converts the editions one after the other and
+	# returns the file masks of the ones that succeeded
+	converted = []
+	for edition in editions:
+		print("\nWriting '%s' with the built-in MOBI writer..." % (edition.name + '.mobi'))
+		start_time = time.time()
+		try:
+			(entries,words) = writeMobi(edition)
+		except ValueError as e:
+			print("\nThe MOBI of '%s' could not be written: %s.\nTemporary files will not be deleted..." % (edition.name,e))
+			continue
+		duration = time.time() - start_time
+		print("MOBI of '%s': %.1f MB, %s entries and %s words in the index, written in %s" % (edition.name,os.path.getsize(edition.name + '.mobi') / 1048576.0,entries,words,time.strftime('%H:%M:%S',time.gmtime(duration))))
+		if metrics:
+			metrics.add('mobi',duration)
+		converted.append(edition.name)
+	return converted
 
 def kindlegen():
 	response = 'n'
+	if args.mobi_writer == 'builtin':
+		# the builtin writer needs nothing on the path, so in interactive mode it is only confirmed
+		if args.interactive:
+			response = raw_input("\nDo you want to convert the OPF to MOBI with the builtin writer? [Y/n]: ") or 'y'
+		if (args.kindlegen) or ((response == 'y') or (response == 'yes')):
+			converted = runMobiWriter(editions)
+			for filemask in converted:
+				deleteTemporaryFiles(filemask)
+			return converted
+		return []
+	
 	try:
-		subprocess.call(['kindlegen'], stdout=subprocess.PIPE)
+		subprocess.call([args.kindlegen_path], stdout=subprocess.PIPE)
 	except OSError, e:
 		if e.errno == errno.ENOENT:
 			print('Kindlegen was not on your path; not generating .MOBI version...')
 			print('You can download kindlegen for Linux/Windows/Mac from http://www.amazon.com/gp/feature.html?docId=1000765211')
-			print('and then run: <kindlegen "%s.opf"> to convert the file to MOBI format.' % name)
-			return
+			for edition in editions:
+				print('and then run: <kindlegen "%s"> to convert the file to MOBI format.' % (edition.name + ('.epub' if args.epub else '.opf')))
+			return []
 		else:
 			raise
 	
 	if args.interactive:
 		response = raw_input("\nKindlegen was found in your path.\nDo you want to launch it to convert the OPF to MOBI? [Y/n]: ") or 'y'
 	if (args.kindlegen) or ((response == 'y') or (response == 'yes')):
-		if runKindlegen():
-				deleteTemporaryFiles()
+		converted = runKindlegen([edition.name for edition in editions])
+		for filemask in converted:
+			deleteTemporaryFiles(filemask)
+		return converted
+	return []
 
-def printSources():
+def readSources():
 	global cur
-	global source_list
 	global source_list_names
 	global source_list_count
 	
+	# returns the id, name and number of definitions of the sources to export
+	sources = []
 	source_list_count = []
 	source_list_names = []
-	cur.execute("select id,concat(name,' ',year) as source, (select count(lexicon) from Definition d where d.status = 0 and d.sourceId = s.id) as defcount from Source s where id in (%s) and canDistribute = 1 order by id" % ','.join(source_list))
-	print("\nSources of dictionaries for export:\n")
+	executeQuery(cur,"select id,concat(name,' ',year) as source, (select count(lexicon) from Definition d where d.status = 0 and d.sourceId = s.id) as defcount from Source s where id in (%s) and canDistribute = 1 order by id" % ','.join(source_list))
 	for i in range(cur.rowcount):
 		src = cur.fetchone()
-		srcid = src["id"]
-		srcname = src["source"]
-		srccount = src["defcount"]
+		sources.append((src["id"],src["source"],src["defcount"]))
+		source_list_names.append(src["source"])
+		source_list_count.append(src["defcount"])
+	return sources
+
+def printSources(sources):
+	print("\nSources of dictionaries for export:\n")
+	for (srcid,srcname,srccount) in sources:
 		print('id:%s defcount:%s name:"%s"'% (srcid,srccount,srcname.encode("utf-8")))
-		source_list_names.append(srcname)
-		source_list_count.append(srccount)
 	print('\n')
 
-def generateStats(filemask,nrdef):
+def generateStats(nrdef):
 	global source_list_names
 	global source_list_count
 	
-	stats = codecs.open(filemask + "_STATS.html","w","utf-8")
-	stats.write(STATSTEMPLATEHEAD % nrdef)
+	stats = STATSTEMPLATEHEAD % nrdef
 	
 	for src in source_list_names:
-		stats.write(STATSVALUETEMPLATE % (source_list_count[source_list_names.index(src)],src))
+		count = source_list_count[source_list_names.index(src)]
+		if budget:
+			count -= budget.dropped_sources[src]	# the definitions left out by --size-budget
+		stats = stats + STATSVALUETEMPLATE % (count,src)
 		
-	stats.write(STATSTEMPLATEEND % time.strftime("%d/%m/%Y"))
-	stats.close
+	notes = u''
+	if args.dedup:
+		notes = STATSDEDUPTEMPLATE % (duplicate_count,duplicate_bytes / 1024.0)
+	if budget:
+		notes = notes + budget.stats()
+	stats = stats + STATSTEMPLATEEND % (notes,time.strftime("%d/%m/%Y"))
+	return stats
 
 def interactiveMode():
 	global mysql_server
@@ -517,14 +3152,14 @@ def interactiveMode():
 	
 	tryConnect()
 	
-	printSources()
+	printSources(readSources())
 	
 	response = raw_input("Do you want to change the default sources list ? [y/N]: ").lower()
 	if (response == 'y') or (response == 'yes'):
 		source_list = []
 		source_list_names = []
 		source_list_count = []
-		cur.execute("select id,concat(name,' ',year) as source,(select count(lexicon) from Definition d where d.status = 0 and d.sourceId = s.id) as defcount from Source s where canDistribute = 1 order by id")
+		executeQuery(cur,"select id,concat(name,' ',year) as source,(select count(lexicon) from Definition d where d.status = 0 and d.sourceId = s.id) as defcount from Source s where canDistribute = 1 order by id")
 		for i in range(cur.rowcount):
 			src = cur.fetchone()
 			response = raw_input('\nUse as a source (%s of %s) %s ? [y/N]: ' % (i+1,cur.rowcount,src["source"].encode("utf-8"))).lower()
@@ -541,62 +3176,282 @@ def interactiveMode():
 			sys.exit()
 	print
 
+class ConnectionPool(object):
+	# keeps the connections to the server (or to the dump index) open between exports,
+	# opening a new one only when all of them are in use
+	def __init__(self, connect, connections = []):
+		self.connect = connect
+		self.idle = list(connections)
+	
+	def get(self):
+		if not self.idle:
+			return self.connect()
+		connection = self.idle.pop()
+		if hasattr(connection,'ping'):
+			connection.ping(True)	# reconnects when the server closed an idle connection
+		return connection
+	
+	def put(self, connection):
+		self.idle.append(connection)
+	
+	def close(self):
+		while self.idle:
+			self.idle.pop().close()
+
+class Exporter(object):
+	# exports the dictionary and converts it to MOBI, so other programs can import this module;
+	# takes a connection (or a ConnectionPool) and the options of the command line (see exportOptions)
+	# and can export several times, with other options too, reusing the connections and the sources read
+	def __init__(self, connection, options):
+		if isinstance(connection,ConnectionPool):
+			self.pool = connection
+		else:
+			self.pool = ConnectionPool(openConnection,[connection])
+		self.options = options
+		self.sources = {}
+		self.editions = []
+		self.start_time = 0
+	
+	def activate(self):
+		global args
+		global mysql_server
+		global mysql_port
+		global mysql_user
+		global mysql_passwd
+		global mysql_db
+		global name
+		global source_list
+		global editions
+		
+		# the functions of the module, and the worker processes of --jobs, work with the globals
+		args = self.options
+		mysql_server = args.server
+		mysql_port = args.port
+		mysql_user = args.username
+		mysql_passwd = args.password
+		mysql_db = args.database
+		name = args.outputfile
+		source_list = [str(source) for source in (args.sources or DEFAULTSOURCES)]
+		editions = self.editions
+	
+	def export(self):
+		global conn
+		global conn2
+		global cur
+		global cur2
+		global source_list_names
+		global source_list_count
+		global inflection_cache
+		global pending_definitions
+		global metrics
+		global query_count
+		global entry_count
+		global diacritic_hits
+		global diacritic_misses
+		global duplicate_count
+		global duplicate_bytes
+		global minify_input
+		global minify_output
+		global minify_time
+		
+		validateOptions(self.options)	# raises ValueError, as the command line would fail
+		self.activate()
+		self.start_time = time.time()
+		inflection_cache = {}
+		pending_definitions = []
+		query_count = 0
+		entry_count = 0
+		diacritic_hits = 0
+		diacritic_misses = 0
+		duplicate_count = 0
+		duplicate_bytes = 0
+		minify_input = 0
+		minify_output = 0
+		minify_time = 0
+		metrics = None
+		if args.metrics:
+			metrics = Metrics()
+		
+		conn = self.pool.get()
+		cur = openCursor(conn)
+		conn2 = ''
+		if args.stream:
+			# while the definitions are streamed the first connection is busy,
+			# so the inflections are read using a second one
+			conn2 = self.pool.get()
+			cur2 = openCursor(conn2)
+		else:
+			cur2 = openCursor(conn)
+		try:
+			key = ','.join(source_list)
+			if key not in self.sources:
+				self.sources[key] = readSources()
+				printSources(self.sources[key])
+			source_list_names = [srcname for (srcid,srcname,srccount) in self.sources[key]]
+			source_list_count = [srccount for (srcid,srcname,srccount) in self.sources[key]]
+			
+			openEditions()
+			self.editions = editions
+			checkpoint = None
+			if args.resume:
+				checkpoint = readCheckpoint()
+			if not (args.incremental or checkpoint):
+				deleteFile(name + '_CHECKPOINT.json')
+				for edition in editions:
+					deleteFiles(edition.name, mobi = True)
+			total = exportDictionaryFiles(checkpoint)
+		finally:
+			cur.close()
+			cur2.close()
+			self.pool.put(conn)
+			if conn2:
+				self.pool.put(conn2)
+		if metrics:
+			writeMetrics(args.metrics,self.start_time)
+		return total
+	
+	def convert(self):
+		# runs kindlegen for the editions of the last export
+		self.activate()
+		converted = kindlegen()
+		if metrics:
+			writeMetrics(args.metrics,self.start_time)
+		return converted
+	
+	def close(self):
+		self.pool.close()
+
+def validateOptions(options):
+	# the options that can not be used together, checked for the command line and for Exporter.export
+	if options.jobs < 1:
+		raise ValueError("argument -j/--jobs: must be at least 1")
+	if options.kindlegen_jobs < 1:
+		raise ValueError("argument --kindlegen-jobs: must be at least 1")
+	if options.epub and (options.jobs > 1 or options.incremental):
+		raise ValueError("argument --epub: not allowed with argument -j/--jobs or --incremental")
+	if options.resume and (options.jobs > 1 or options.incremental or options.epub):
+		raise ValueError("argument --resume: not allowed with argument -j/--jobs, --incremental or --epub")
+	if options.pipeline and (options.jobs > 1 or options.incremental):
+		raise ValueError("argument --pipeline: not allowed with argument -j/--jobs or --incremental")
+	if options.formats and (options.jobs > 1 or options.incremental or options.resume):
+		raise ValueError("argument --formats: not allowed with argument -j/--jobs, --incremental or --resume")
+	if options.lookup_index and (options.jobs > 1 or options.incremental or options.resume):
+		raise ValueError("argument --lookup-index: not allowed with argument -j/--jobs, --incremental or --resume")
+	if options.size_budget is not None and (options.size_budget <= 0 or options.jobs > 1 or options.incremental):
+		raise ValueError("argument --size-budget: must be positive, not allowed with argument -j/--jobs or --incremental")
+	# the files a letter is split into depend on the entries taken, so their heads are not in the estimate
+	if options.size_budget is not None and (options.max_file_size or options.max_entries_per_file):
+		raise ValueError("argument --size-budget: not allowed with argument --max-file-size or --max-entries-per-file")
+	if options.frequency_list and options.size_budget is None:
+		raise ValueError("argument --frequency-list: only allowed with argument --size-budget")
+
+def exportOptions(**options):
+	# the options of the command line with their default values, changed by the keyword arguments
+	# (named as the long options, e.g. exportOptions(outputfile = 'DEX', sources = ['27','36'], group_entries = True))
+	args = argumentParser().parse_args(['-b'])
+	for option in options:
+		if not hasattr(args,option):
+			raise TypeError("Unknown export option '%s'" % option)
+		setattr(args,option,options[option])
+	return args
+
 ################################################################
 # MAIN
 ################################################################
 
-signal.signal(signal.SIGINT, signal_handler)
-
-parser = argparse.ArgumentParser(add_help=False,formatter_class=RawTextHelpFormatter)
-group = parser.add_mutually_exclusive_group(required=True)
-group.add_argument("-i","--interactive",help="run the program in interactive mode",action="store_true")
-group.add_argument("-b","--batch",help="run the program in batch mode, taking parameters from command line",action="store_true")
-group.add_argument("-h","--help",help="print this help file",action="help")
-group.add_argument("-v","--version",help="print the program's version",action="version",version='%(prog)s ' + VERSION)
-
-batchgroup = parser.add_argument_group("Batch arguments")
-batchgroup.add_argument("-s","--server",help="Specify the mysql server to connect to.\nDefault: 'localhost'",type=str,default="localhost")
-batchgroup.add_argument("-p","--port",help="Mysql server port.\nDefault: 3306",type=int,default=3306)
-batchgroup.add_argument("-u","--username",help="Specify the username to connect to mysql server.\nDefault: 'root'",type=str,default="root")
-batchgroup.add_argument("-passwd","--password",help="The password of the mysql server.",type=str)
-batchgroup.add_argument("-d","--database",help="DEX database on the mysql server.\nDefault: 'DEX'",type=str,default="DEX")
-batchgroup.add_argument("-src","--sources",help="List of dictionary sources to extract from database.\nMust contain the sources id's from the table 'sources'.\nIf some source doesn't exist or can't be distributed, it will be removed from the list.\nDefault: 27 36",nargs='+',type=str)
-batchgroup.add_argument("-o","--outputfile",help="Filename of output file.\nMay include path.\nExisting files will be deleted first.\nDefault: 'DEXonline'",type=str,default="DEXonline")
-batchgroup.add_argument("--diacritics",help="Specify how the diacritics should be exported.\nDefault: 'both'",choices=['comma','cedilla','both'],type=str,default="both")
-
-batchgroup2 = batchgroup.add_mutually_exclusive_group()
-batchgroup2.add_argument("-k","--kindlegen",help="Do not run kindlegen to convert the output to MOBI.\nDefault: not set",action="store_false",default=True)
-batchgroup2.add_argument("-t","--temp_files",help="Keep the temporary files after running kindlegen.\nDefault: not set",action="store_false",default=True)
-
-args = parser.parse_args()
-
-if args.interactive:
-	args.kindlegen = False
-	args.temp_files = False
-	interactiveMode()
-else:
-	mysql_server = args.server
-	mysql_port = args.port
-	mysql_user = args.username
-	mysql_passwd = args.password
-	mysql_db = args.database
-	name = args.outputfile
-	if not args.temp_files:
-		print("\nWill not remove temporary files after a (successful) conversion with kindlegen...")
-	if not args.kindlegen:
-		print("\nWill not automatically try to run kindlegen after exporting the dictionary.\nTemporary files will be preserved...")
+def argumentParser():
+	parser = argparse.ArgumentParser(add_help=False,formatter_class=RawTextHelpFormatter)
+	group = parser.add_mutually_exclusive_group(required=True)
+	group.add_argument("-i","--interactive",help="run the program in interactive mode",action="store_true")
+	group.add_argument("-b","--batch",help="run the program in batch mode, taking parameters from command line",action="store_true")
+	group.add_argument("-h","--help",help="print this help file",action="help")
+	group.add_argument("-v","--version",help="print the program's version",action="version",version='%(prog)s ' + VERSION)
+
+	batchgroup = parser.add_argument_group("Batch arguments")
+	batchgroup.add_argument("-s","--server",help="Specify the mysql server to connect to.\nDefault: 'localhost'",type=str,default="localhost")
+	batchgroup.add_argument("-p","--port",help="Mysql server port.\nDefault: 3306",type=int,default=3306)
+	batchgroup.add_argument("-u","--username",help="Specify the username to connect to mysql server.\nDefault: 'root'",type=str,default="root")
+	batchgroup.add_argument("-passwd","--password",help="The password of the mysql server.",type=str)
+	batchgroup.add_argument("-d","--database",help="DEX database on the mysql server.\nDefault: 'DEX'",type=str,default="DEX")
+	batchgroup.add_argument("--dump",help="Read the DEXonline SQL dump (may be gzipped) instead of connecting to a mysql server.\nA temporary index is built next to the output file.",type=str)
+	batchgroup.add_argument("-src","--sources",help="List of dictionary sources to extract from database.\nMust contain the sources id's from the table 'sources'.\nIf some source doesn't exist or can't be distributed, it will be removed from the list.\nDefault: 27 36",nargs='+',type=str)
+	batchgroup.add_argument("-o","--outputfile",help="Filename of output file.\nMay include path.\nExisting files will be deleted first.\nDefault: 'DEXonline'",type=str,default="DEXonline")
+	batchgroup.add_argument("--diacritics",help="Specify how the diacritics should be exported.\n'all' also exports the terms and inflections without diacritics as searchable forms.\nDefault: 'both'",choices=['comma','cedilla','both','all'],type=str,default="both")
+	batchgroup.add_argument("--editions",help="Export several editions of the dictionary from the same definitions, one for each diacritics option given.\nThe files of each edition are named <outputfile>_<option>.\nDefault: not set",nargs='+',choices=['comma','cedilla','both','all'],type=str)
+	batchgroup.add_argument("--max-file-size",help="Maximum size of a letter file, in MB.\nThe entries that do not fit go to the next file of the letter (<outputfile>_<letter>_2.html, ...).\nDefault: not set",type=float)
+	batchgroup.add_argument("--max-entries-per-file",help="Maximum number of entries in a letter file.\nThe entries that do not fit go to the next file of the letter (<outputfile>_<letter>_2.html, ...).\nDefault: not set",type=int)
+	batchgroup.add_argument("-g","--group-entries",help="Export a single entry for each headword, with the definitions of all the sources under it\nand the inflections of all the definitions merged.\nDefault: not set",action="store_true")
+	batchgroup.add_argument("--dedup",help="Export only once the definitions of a headword having the same text (but for the spaces) in several sources,\nwith all their sources; the number of duplicates and the bytes saved are shown on the stats page.\nDefault: not set",action="store_true")
+	batchgroup.add_argument("--minify",help="Compact the HTML of the definitions: the runs of spaces, the class attributes, the empty tags and the spans\nwithout attributes are dropped, and the abbreviations having the meaning listed in 'Abrevieri.html' lose their title.\nThe text shown is the same; the size of the definitions before and after and the time per MB are shown at the end.\nDefault: not set",action="store_true")
+	batchgroup.add_argument("--size-budget",help="Export a compact edition whose letter files and stats page fit in the given size, in MB: the headwords are ranked by their rank\nin the --frequency-list, the number of sources defining them and the number of their inflected forms, and taken in this order\nwhile their estimated size fits, some of them without their inflected forms. The definitions are read twice, the first time\nto estimate the size of the entries. The headwords left out are listed on the stats page.\nCan not be used with --jobs, --incremental, --max-file-size or --max-entries-per-file.\nDefault: not set",type=float)
+	batchgroup.add_argument("--frequency-list",help="Text file with the most frequent words first, one on each line, ranking the headwords of --size-budget\nbefore the number of their sources and inflected forms.\nDefault: not set",type=str)
+	batchgroup.add_argument("-j","--jobs",help="Number of processes exporting the letter files in parallel.\nEach process uses its own connection to the mysql server.\nDefault: 1",type=int,default=1)
+	batchgroup.add_argument("--incremental",help="Only export again the letter files whose definitions or inflections changed since the previous run.\nThe state of the files is kept in '<outputfile>_BUILD.json' and the temporary files are preserved.\nDefault: not set",action="store_true")
+	batchgroup.add_argument("--stream",help="Stream the definitions from the mysql server instead of loading them all in memory.\nUses a second connection for the inflections.\nDefault: not set",action="store_true")
+
+	batchgroup.add_argument("--client-sort",help="Sort the definitions in the order of the Romanian alphabet (ă and â after a, î after i, ș and ț after s and t) here,\ninstead of on the mysql server, whose collation puts a, ă and â together; the server reads them in the order of their ids.\nThe letter files follow the Romanian letters too. The runs of %d MB sorted in memory are kept in temporary files\nnext to the output file, so the memory used does not depend on the number of definitions.\nDefault: not set" % (SORTRUN / 1048576),action="store_true")
+	batchgroup.add_argument("--pipeline",help="Read the definitions and their inflections, render the entries and write the letter files at the same time,\nin three threads connected by queues holding a few windows of definitions and chunks of the letter files.\nThe output is the same as without it.\nCan not be used with --jobs or --incremental.\nDefault: not set",action="store_true")
+	batchgroup.add_argument("--resume",help="Continue an interrupted export from its last checkpoint, saved in '<outputfile>_CHECKPOINT.json'\nafter each %d definitions; the options must be the same.\nCan not be used with --jobs, --incremental or --epub.\nDefault: not set" % DEFINITIONSCHUNK,action="store_true")
+	batchgroup.add_argument("--epub",help="Write the letter files, the TOC, the stats and the OPF, with the cover and the abbreviations page,\nstraight into '<outputfile>.epub' instead of separate files; kindlegen converts the .epub.\nThe container holds an EPUB 3 package document, a navigation document and XHTML pages; the dictionary markup\nof kindlegen (idx:entry, mbp:frameset...) is kept in the pages, so EPUB validators report it.\nCan not be used with --jobs or --incremental.\nDefault: not set",action="store_true")
+	batchgroup.add_argument("--formats",help="Also write the dictionary in other formats, from the same export: 'stardict' ('<outputfile>.ifo', .idx, .syn and .dict.dz)\nand 'dictd' ('<outputfile>_dictd.index' and '<outputfile>_dictd.dict.dz'); the diacritic variants and the inflected forms\nare synonyms of the headword.\nCan not be used with --jobs, --incremental or --resume.\nDefault: not set",nargs='+',choices=['stardict','dictd'],type=str)
+	batchgroup.add_argument("--lookup-index",help="Also write '<outputfile>_LOOKUP.idx', an index of the headwords and inflected forms (idx:orth and idx:iform)\nwith the entries they find, to check with lookup.py which entries a search would hit.\nCan not be used with --jobs, --incremental or --resume.\nDefault: not set",action="store_true")
+	batchgroup.add_argument("--metrics",help="Write a JSON report of the time spent in each phase of the export, the number of definitions, entries and queries,\nthe size of the letter files and the slowest inflection lookups.\nDefault: not set",type=str)
+	batchgroup.add_argument("--mobi-writer",help="How the dictionary is converted to MOBI: by running kindlegen, or by the 'builtin' MOBI writer,\nwhich needs no kindlegen and makes the inflected forms searchable as words of the index.\nDefault: 'kindlegen'",choices=['kindlegen','builtin'],type=str,default="kindlegen")
+	batchgroup.add_argument("--kindlegen-path",help="The kindlegen executable to run.\nDefault: 'kindlegen'",type=str,default="kindlegen")
+	batchgroup.add_argument("--kindlegen-jobs",help="Number of kindlegen conversions (one for each edition) to run at the same time.\nDefault: 1",type=int,default=1)
+	batchgroup.add_argument("--kindlegen-timeout",help="Stop a kindlegen conversion after the given number of seconds.\nDefault: not set",type=int)
+	
+	batchgroup2 = batchgroup.add_mutually_exclusive_group()
+	batchgroup2.add_argument("-k","--kindlegen",help="Do not run kindlegen to convert the output to MOBI.\nDefault: not set",action="store_false",default=True)
+	batchgroup2.add_argument("-t","--temp_files",help="Keep the temporary files after running kindlegen.\nDefault: not set",action="store_false",default=True)
+	return parser
+
+# the worker processes of --jobs import this module, so the program only runs when started directly
+if __name__ == '__main__':
+	signal.signal(signal.SIGINT, signal_handler)
+
+	parser = argumentParser()
+	args = parser.parse_args()
+	try:
+		validateOptions(args)
+	except ValueError as e:
+		parser.error(str(e))
+
+	if args.interactive:
+		args.kindlegen = False
 		args.temp_files = False
+		interactiveMode()
+		# the answers are the options of the export
+		(args.server,args.port,args.username,args.password,args.database,args.outputfile,args.sources) = (mysql_server,int(mysql_port),mysql_user,mysql_passwd,mysql_db,name,source_list)
+	else:
+		mysql_server = args.server
+		mysql_port = args.port
+		mysql_user = args.username
+		mysql_passwd = args.password
+		mysql_db = args.database
+		name = args.outputfile
+		if not args.temp_files:
+			print("\nWill not remove temporary files after a (successful) conversion with kindlegen...")
+		if not args.kindlegen:
+			print("\nWill not automatically try to run kindlegen after exporting the dictionary.\nTemporary files will be preserved...")
+			args.temp_files = False
+		if args.incremental and args.temp_files:
+			print("\nThe letter files are needed by the next incremental run.\nTemporary files will be preserved...")
+			args.temp_files = False
 	
-	tryConnect()
-	print("\nSuccessfully connected to database '%s' on '%s:%d', using username '%s' and password '%s'..." % (mysql_db,mysql_server,mysql_port,mysql_user,'*' * len(mysql_passwd)))
-	if args.sources:
-		source_list = args.sources
+		conn = openConnection()
+		if args.dump:
+			print("\nSuccessfully indexed the dump '%s'..." % args.dump)
+		else:
+			print("\nSuccessfully connected to database '%s' on '%s:%d', using username '%s' and password '%s'..." % (mysql_db,mysql_server,mysql_port,mysql_user,'*' * len(mysql_passwd)))
 	
-	printSources()
-
-deleteFiles(name, mobi = True)
-exportDictionaryFiles()
-kindlegen()
+	exporter = Exporter(conn,args)
+	if args.interactive:
+		# the sources were already read (and chosen) by the interactive mode
+		exporter.sources[','.join(source_list)] = zip(source_list,source_list_names,source_list_count)
+	exporter.export()
+	exporter.convert()
+	exporter.close()
 
-if args.interactive:
-	raw_input("\nPress <ENTER> to exit...")
+	if args.interactive:
+		raw_input("\nPress <ENTER> to exit...")
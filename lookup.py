@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# lookup.py - searches the lookup index written by dex2xml.py --lookup-index
+#
+# Shows the entries a search for a word would hit: the entries having it as headword (idx:orth)
+# or as inflected form (idx:iform), with the letter file and the offset of each entry.
+#
+# usage: lookup.py [-p] [-n LIMIT] [--text] LOOKUPINDEX WORD [WORD ...]
+#
+# e.g.:  lookup.py DEXonline_LOOKUP.idx mașină mașini
+#        lookup.py -p DEXonline_LOOKUP.idx mași
+
+import sys
+import io
+import os
+import time
+import zipfile
+import argparse
+from argparse import RawTextHelpFormatter
+
+import dex2xml
+
+def openContainer(indexname):
+	# with --epub the letter files are members of '<outputfile>.epub', next to '<outputfile>_LOOKUP.idx'
+	if not indexname.endswith('_LOOKUP.idx'):
+		return None
+	filename = indexname[:-len('_LOOKUP.idx')] + '.epub'
+	if not os.path.isfile(filename):
+		return None
+	return zipfile.ZipFile(filename)
+
+def entryText(filename,offset,length,container = None):
+	# the entry, read from its letter file (when it was not deleted after kindlegen) or from the --epub container
+	if container and filename in container.NameToInfo:
+		f = container.open(filename)
+		f.read(offset)
+	else:
+		try:
+			f = io.open(filename,'rb')
+		except IOError:
+			return None
+		f.seek(offset)
+	text = f.read(length).decode('utf-8')
+	f.close()
+	return dex2xml.htmlText(text)
+
+def printEntries(entries,text,container = None):
+	for (headword,kind,filename,offset,length) in entries:
+		print((u"    %s (%s) - %s @ %s, %s bytes" % (headword,kind,filename,offset,length)).encode('utf-8'))
+		if text:
+			content = entryText(filename,offset,length,container)
+			if content is None:
+				print((u"        (the letter file '%s' was not found)" % filename).encode('utf-8'))
+			else:
+				print((u''.join(u"        " + line + u"\n" for line in content.split(u"\n"))).encode('utf-8'))
+
+def main():
+	parser = argparse.ArgumentParser(description="Searches the lookup index written by dex2xml.py --lookup-index.",formatter_class=RawTextHelpFormatter)
+	parser.add_argument("-p","--prefix",help="Show the words starting with the given ones, instead of the exact matches.\nDefault: not set",action="store_true")
+	parser.add_argument("-n","--limit",help="Maximum number of words shown for each prefix.\nDefault: 50",type=int,default=50)
+	parser.add_argument("--text",help="Show also the text of the entries, read from the letter files (or from '<outputfile>.epub',\nwhen they were written with --epub).\nDefault: not set",action="store_true")
+	parser.add_argument("index",help="The lookup index ('<outputfile>_LOOKUP.idx').")
+	parser.add_argument("words",help="The words to search for.",nargs='+')
+	args = parser.parse_args()
+
+	start_time = time.time()
+	index = dex2xml.LookupIndex(args.index)
+	print("Opened '%s' (%s words of %s entries) in %.0f us" % (args.index,index.keys,index.entries,(time.time() - start_time) * 1000000))
+	container = openContainer(args.index) if args.text else None
+
+	for word in args.words:
+		word = word.decode(sys.stdin.encoding or 'utf-8')
+		start_time = time.time()
+		if args.prefix:
+			words = index.prefix(word,args.limit)
+		else:
+			words = [(word,index.lookup(word))]
+		duration = time.time() - start_time
+		print((u"\n'%s': %s entries, found in %.0f us" % (word,sum(len(entries) for (found,entries) in words),duration * 1000000)).encode('utf-8'))
+		for (found,entries) in words:
+			if args.prefix:
+				print((u"  %s" % found).encode('utf-8'))
+			printEntries(entries,args.text,container)
+	index.close()
+	if container:
+		container.close()
+
+if __name__ == '__main__':
+	main()